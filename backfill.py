@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Per-item summaries of every archived snapshot, computed in parallel.
+
+The `ah/` and `bliz-ah/` directories hold every snapshot ever fetched.  New
+derived views have to be computed over all of them, and unpickling them one
+after another on one core is slow.  `backfill` hands the snapshots to a
+process pool; each worker unpickles one and sends back a few compact columns
+per item (see `summarizers`), and the results are appended to a
+`SummaryStore` in timestamp order.
+
+The store is committed every few snapshots and remembers the time of the
+last one it has, so an interrupted backfill picks up from there, and
+running it again later only does the snapshots taken since.
+"""
+import datetime
+import os
+import pickle
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from instrument import count
+from instrument import span
+
+
+# Stored for values a snapshot doesn't have, which 0 would be mistaken for
+missing = -1
+
+_itemsize = array("q").itemsize
+
+
+def tsm_summary(tsm_ah):
+    """
+    {column: values} with a row per item of a TSM snapshot.
+
+    Values the record doesn't have are `missing`.
+    """
+    columns = {
+        "item_id": array("q"),
+        "marketValue": array("q"),
+        "minBuyout": array("q"),
+        "quantity": array("q"),
+    }
+    for (item_id, record) in tsm_ah.items():
+        columns["item_id"].append(item_id)
+        for c in ["marketValue", "minBuyout", "quantity"]:
+            value = record.get(c)
+            columns[c].append(missing if value is None else int(value))
+    return columns
+
+
+def bliz_summary(bliz_ah):
+    """{column: values} with a row per item of a Blizzard snapshot."""
+    columns = {
+        "item_id": array("q"),
+        "min": array("q"),
+        "quantity": array("q"),
+        "auctions": array("q"),
+    }
+    for (item_id, auctions) in bliz_ah.items():
+        if not auctions:
+            continue
+        columns["item_id"].append(item_id)
+        columns["min"].append(int(min(a["price"] for a in auctions)))
+        columns["quantity"].append(sum(a["quantity"] for a in auctions))
+        columns["auctions"].append(len(auctions))
+    return columns
+
+
+# kind -> (context attribute of its SnapshotProcessor, summarizer)
+summarizers = {
+    "tsm": ("tsm_ah_snap", tsm_summary),
+    "bliz": ("bliz_ah_snap", bliz_summary),
+}
+
+
+def _summarize(args):
+    (kind, path) = args
+    with open(path, "rb") as f:
+        snapshot = pickle.load(f)
+    return summarizers[kind][1](snapshot)
+
+
+class SummaryStore:
+    """
+    The summary rows of one kind of snapshot, in timestamp order.
+
+    `columns` maps each summary column, plus "time" (POSIX seconds of the
+    snapshot), to an array with a row per item per snapshot.
+
+    The store at `path` is two files: `path` itself, a small pickle of the
+    column names and the number of rows each `append` added, and
+    `{path}.rows`, where those rows are appended column by column, so a
+    commit only writes what was added since the last one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows_path = f"{path}.rows"
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except OSError:
+            state = {}
+        # Time of the newest snapshot in the store
+        self.last_time = state.get("last_time")
+        # Column names, "time" first, in the order they are in the row file
+        self.names = state.get("names", [])
+        # Rows of each appended snapshot, in the row file
+        self.segments = state.get("segments", [])
+        # Anything after the committed rows was written by a commit that
+        # didn't finish
+        size = sum(self.segments) * len(self.names) * _itemsize
+        if (
+            os.path.exists(self.rows_path) and
+            os.path.getsize(self.rows_path) > size
+        ):
+            with open(self.rows_path, "r+b") as f:
+                f.truncate(size)
+        # [{column: values}] appended since the last commit
+        self._pending = []
+        self._columns = None
+        if state.get("columns"):
+            # Stores from before the row file: written to it on the next
+            # commit
+            columns = state["columns"]
+            self.names = list(columns)
+            self.segments = [len(columns["time"])]
+            self._pending = [columns]
+        # item_id -> row numbers, made on first use
+        self._rows = None
+
+    def commit(self):
+        """Append the new rows to the row file and save the segment sizes."""
+        if self._pending:
+            with open(self.rows_path, "ab") as f:
+                for columns in self._pending:
+                    for c in self.names:
+                        columns[c].tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        state = {
+            "last_time": self.last_time,
+            "names": self.names,
+            "segments": self.segments,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f)
+        os.replace(tmp_path, self.path)
+        self._pending = []
+
+    @property
+    def columns(self):
+        """
+        {column: values} of every row, oldest first.
+
+        Read from the row file on first use.
+        """
+        if self._columns is None:
+            self._columns = {c: array("q") for c in self.names}
+            committed = self.segments[:len(self.segments) - len(self._pending)]
+            if committed:
+                with open(self.rows_path, "rb") as f:
+                    for n in committed:
+                        for c in self.names:
+                            self._columns[c].fromfile(f, n)
+            for columns in self._pending:
+                for c in self.names:
+                    self._columns[c].extend(columns[c])
+        return self._columns
+
+    def append(self, time, columns):
+        n = len(columns["item_id"])
+        if not self.names:
+            self.names = ["time"] + list(columns)
+        columns = dict(columns, time=array("q", [int(time.timestamp())]) * n)
+        first = sum(self.segments)
+        self._pending.append(columns)
+        self.segments.append(n)
+        if self._columns is not None:
+            for c in self.names:
+                self._columns[c].extend(columns[c])
+        if self._rows is not None:
+            for (j, item_id) in enumerate(columns["item_id"], start=first):
+                self._rows.setdefault(item_id, array("q")).append(j)
+        self.last_time = time
+
+    def rows(self, item_id):
+        """Row numbers of `item_id`, oldest first."""
+        if self._rows is None:
+            self._rows = {}
+            for (j, i) in enumerate(self.columns.get("item_id", [])):
+                self._rows.setdefault(i, array("q")).append(j)
+        return self._rows.get(item_id, array("q"))
+
+    def series(self, item_id, column):
+        """
+        [(time, value)] of `column` for `item_id`, oldest first.
+
+        Snapshots where the value is `missing` are left out.
+        """
+        times = self.columns.get("time")
+        values = self.columns.get(column)
+        if times is None or values is None:
+            return []
+        return [
+            (datetime.datetime.fromtimestamp(times[j]), values[j])
+            for j in self.rows(item_id)
+            if values[j] != missing
+        ]
+
+
+def backfill(kind, snapshot_processor, store: SummaryStore, jobs=None,
+             checkpoint_every=50):
+    """
+    Summarize the snapshots of `snapshot_processor` not in `store` yet.
+
+    Runs `jobs` worker processes (None for one per core) and commits the
+    store every `checkpoint_every` snapshots.  Returns how many were added.
+    """
+    start = (
+        None if store.last_time is None
+        else store.last_time + datetime.timedelta(microseconds=1)
+    )
+    todo = snapshot_processor.archive(start)
+    added = 0
+    with span("backfill"):
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            # `map` gives the results in the order of `todo`, oldest first,
+            # while the workers run ahead
+            results = pool.map(
+                _summarize,
+                [(kind, path) for (_, path) in todo],
+                chunksize=4,
+            )
+            for ((time, _), columns) in zip(todo, results):
+                store.append(time, columns)
+                added += 1
+                count("backfill.snapshots")
+                if added % checkpoint_every == 0:
+                    store.commit()
+    store.commit()
+    return added
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Summarize every archived snapshot per item",
+    )
+    parser.add_argument(
+        "kinds",
+        nargs="*",
+        metavar="kind",
+        help=f"Which archives to backfill ({', '.join(sorted(summarizers))})",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default=".",
+        help="Directory of the {kind}-summary.pkl stores",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=0,
+        help="Worker processes (0 for one per core)",
+    )
+    parser.add_argument("--checkpoint-every", type=int, default=50)
+    parsed = parser.parse_args()
+    kinds = parsed.kinds or sorted(summarizers)
+    for kind in kinds:
+        if kind not in summarizers:
+            parser.error(f"unknown kind: '{kind}'")
+
+    from context import current
+
+    ctx = current()
+    for kind in kinds:
+        store = SummaryStore(
+            os.path.join(parsed.output, f"{kind}-summary.pkl"),
+        )
+        added = backfill(
+            kind,
+            getattr(ctx, summarizers[kind][0]),
+            store,
+            jobs=parsed.jobs or None,
+            checkpoint_every=parsed.checkpoint_every,
+        )
+        print(f"{kind}: {added} snapshots added, up to {store.last_time}")
+
+
+if __name__ == "__main__":
+    main()
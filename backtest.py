@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+What a craft plan would have cost and earned over the snapshot archive.
+
+The TSM snapshots saved by a `SnapshotProcessor` are read once into a
+`PriceMatrix`: one row per snapshot, one column per item.  A plan is a
+vector of reagent counts (its procured `CraftingComponents`) and its product
+another, so its cost and value at every snapshot are two matrix-vector
+products, however many snapshots there are.
+
+Unpickling the archive is by far the slow part, so a matrix can be saved
+(`--store`) along with the span of the archive it covers; next time only
+snapshots outside that span are read.
+"""
+import datetime
+
+import numpy as np
+
+import config
+from crafting import CraftingComponents
+from crafting import Procure
+from instrument import count
+from instrument import span
+from instrument import timed
+
+
+class PriceMatrix:
+    """
+    Prices of `item_ids` at each of `times`.
+
+    `values[t, j]` is the price of `item_ids[j]` in the snapshot taken at
+    `times[t]`, NaN where the snapshot has none.
+    """
+
+    def __init__(self, item_ids, times=None, values=None,
+                 price_param="marketValue", since=datetime.datetime.max):
+        self.item_ids = list(item_ids)
+        self.times = list(times or [])
+        self.values = (
+            values if values is not None
+            else np.empty((0, len(self.item_ids)))
+        )
+        self.price_param = price_param
+        # Every archived snapshot from this time on is in the matrix (None
+        # for the whole archive; `datetime.max` while it is still empty)
+        self.since = since
+        self._column = {
+            item_id: j for (j, item_id) in enumerate(self.item_ids)
+        }
+
+    def _row(self, tsm_ah):
+        row = np.full(len(self.item_ids), np.nan)
+        for (j, item_id) in enumerate(self.item_ids):
+            record = tsm_ah.get(item_id)
+            if record is not None and record.get(self.price_param):
+                row[j] = record[self.price_param]
+        return row
+
+    def _read(self, snapshot_processor, start, end):
+        archive = snapshot_processor.archive(start, end)
+        rows = [
+            self._row(snapshot_processor.load(path)) for (_, path) in archive
+        ]
+        count("backtest.snapshots", len(rows))
+        return ([time for (time, _) in archive], rows)
+
+    @timed("backtest.update")
+    def update(self, snapshot_processor, start=None, end=None):
+        """
+        Make sure every archived snapshot from `start` (None for all of
+        them) up to `end` is in the matrix; return how many were added.
+
+        Snapshots older than what the matrix has are read only if `start`
+        asks for them, and newer ones up to `end`.
+        """
+        added = 0
+        if self.since is not None and (start is None or start < self.since):
+            # Further back than before
+            (times, rows) = self._read(
+                snapshot_processor,
+                start,
+                self.times[0] if self.times else end,
+            )
+            if rows:
+                self.times[:0] = times
+                self.values = np.vstack([rows, self.values])
+            # An empty matrix with nothing read still has everything to read
+            if self.times:
+                self.since = start
+            added += len(rows)
+        if self.times:
+            (times, rows) = self._read(
+                snapshot_processor,
+                self.times[-1] + datetime.timedelta(microseconds=1),
+                end,
+            )
+            if rows:
+                self.times.extend(times)
+                self.values = np.vstack([self.values, rows])
+            added += len(rows)
+        return added
+
+    def covers(self, item_ids):
+        return all(item_id in self._column for item_id in item_ids)
+
+    def _vector(self, item: CraftingComponents):
+        """The counts of `item` as a column vector."""
+        vector = np.zeros(len(self.item_ids))
+        for (_, n, item_id) in item.triples():
+            vector[self._column[item_id]] += n
+        return vector
+
+    def value(self, item: CraftingComponents):
+        """Price of `item` (any number of components) at every snapshot."""
+        with span("backtest.matvec"):
+            return self.values @ self._vector(item)
+
+    def save(self, path):
+        np.savez(
+            path,
+            item_ids=np.array(self.item_ids),
+            times=np.array(self.times, dtype="datetime64[us]"),
+            values=self.values,
+            price_param=self.price_param,
+            since="" if self.since is None else self.since.isoformat(),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(
+                f["item_ids"].tolist(),
+                f["times"].astype(object).tolist(),
+                f["values"],
+                price_param=str(f["price_param"]),
+                # Stores from before this was recorded: check for older
+                # snapshots on the next update
+                since=(
+                    datetime.datetime.max if "since" not in f.files
+                    else datetime.datetime.fromisoformat(str(f["since"]))
+                    if str(f["since"]) else None
+                ),
+            )
+
+
+def plan_reagents(plan):
+    """The procured items of a `procurement_options` plan, as one vector."""
+    (_, operations) = plan
+    return CraftingComponents.sum(
+        op.item for (_, op, _) in operations if isinstance(op, Procure)
+    )
+
+
+def backtest(prices: PriceMatrix, plan, product: CraftingComponents):
+    """
+    {"time", "cost", "value", "margin"} series of making `product` by `plan`.
+
+    `value` is what `product` sold for at each snapshot and `margin` what
+    is left of that after the AH cut and the cost of the reagents.
+    """
+    cost = prices.value(plan_reagents(plan))
+    value = prices.value(product)
+    return {
+        "time": prices.times,
+        "cost": cost,
+        "value": value,
+        "margin": value * (1 - config.ah_cut) - cost,
+    }
+
+
+def main():
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(
+        description=(
+            "Evaluate today's best plan for something against every archived "
+            "TSM snapshot"
+        ),
+    )
+    parser.add_argument("-r", "--recipes", default="recipes.txt")
+    parser.add_argument("-p", "--price-param", default="marketValue")
+    parser.add_argument(
+        "-d", "--days",
+        type=float,
+        help="Only the snapshots of the last this many days",
+    )
+    parser.add_argument(
+        "-s", "--store",
+        help="Keep the price matrix in this .npz file between runs",
+    )
+    parser.add_argument("arg", help="What to make, e.g. '5 titanium bar'")
+    parsed = parser.parse_args()
+
+    from context import current
+    from crafting import top_procurement_options
+    from procure import format_gold
+    from procurement import PriceTable
+
+    ctx = current()
+    r = ctx.recipes
+    with open(parsed.recipes) as f:
+        r.read_from_file(f)
+    product = r.ingredients(parsed.arg)
+    tree = r.tree(product)
+    [plan] = top_procurement_options(PriceTable.for_tree(tree), tree, 1)
+
+    item_ids = set(
+        item_id
+        for vector in [plan_reagents(plan), product]
+        for (_, _, item_id) in vector.triples()
+    )
+    prices = None
+    if parsed.store and os.path.exists(parsed.store):
+        prices = PriceMatrix.load(parsed.store)
+        if (
+            prices.price_param != parsed.price_param or
+            not prices.covers(item_ids)
+        ):
+            prices = None
+    if prices is None:
+        prices = PriceMatrix(sorted(item_ids), price_param=parsed.price_param)
+    start = (
+        datetime.datetime.now() - datetime.timedelta(days=parsed.days)
+        if parsed.days else None
+    )
+    prices.update(ctx.tsm_ah_snap, start=start)
+    if parsed.store:
+        prices.save(parsed.store)
+
+    def _gold(x):
+        return "?" if np.isnan(x) else format_gold(x)
+
+    series = backtest(prices, plan, product)
+    for (time, cost, value, margin) in zip(
+        series["time"], series["cost"], series["value"], series["margin"],
+    ):
+        if start is not None and time < start:
+            continue
+        print(
+            f"{time:%Y-%m-%d %H:%M}  cost {_gold(cost): >16}  "
+            f"value {_gold(value): >16}  "
+            f"margin {'-' if margin < 0 else ' '}{_gold(margin): >16}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for the hot paths.
+
+The benchmarks run the real code (`auction_data`, `auction_house_snapshot`,
+`auction_summary`, `Recipes`, `dnf`, `procurement_options`,
+`top_procurement_options`, `InefficientKVStore.commit`) against a local
+stand-in for the Blizzard and TSM APIs which serves recorded payloads from
+`fixtures/`:
+
+    fixtures/bliz-auctions.json.gz  raw connected-realm auctions response
+    fixtures/tsm-ah.json.gz         raw TSM /ah/{ah_id} response
+    fixtures/tsm-region.json.gz     raw TSM /region/{region_id} response
+    fixtures/items.json.gz          {item name: item id} for the recipe file
+
+Capture real payloads with `benchmark.py record` (needs API credentials), or
+generate deterministic synthetic ones with `benchmark.py synthesize`.  `run`
+synthesizes them if there are none.
+
+Each run appends its per-stage timings and peak memory to a results file, and
+compares them to the most recent run of a different version of the code.
+"""
+import datetime
+import gzip
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import config
+
+
+fixture_names = {
+    "bliz_auctions": "bliz-auctions.json.gz",
+    "tsm_ah": "tsm-ah.json.gz",
+    "tsm_region": "tsm-region.json.gz",
+    "items": "items.json.gz",
+}
+
+default_targets = [
+    "mechano-hog",
+    "spellweave robe",
+    "skyflare diamond",
+    "indestructible potion",
+]
+
+
+#
+# Fixtures
+#
+
+
+def _fixture_path(fixture_dir, name):
+    return os.path.join(fixture_dir, fixture_names[name])
+
+
+def save_fixture(fixture_dir, name, data):
+    os.makedirs(fixture_dir, exist_ok=True)
+    with gzip.open(_fixture_path(fixture_dir, name), "wt") as f:
+        json.dump(data, f)
+
+
+def load_fixture(fixture_dir, name):
+    with gzip.open(_fixture_path(fixture_dir, name), "rt") as f:
+        return json.load(f)
+
+
+def have_fixtures(fixture_dir):
+    return all(
+        os.path.exists(_fixture_path(fixture_dir, name))
+        for name in fixture_names
+    )
+
+
+def recipe_item_names(recipes_path):
+    """All item names mentioned in a recipe file, normalized."""
+    names = set()
+    with open(recipes_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            for part in re.split(r"\s*[+]\s*", line):
+                name = re.search(r"(\d+)?\s*[*]?\s*(.*)", part.strip()).group(2)
+                names.add(name.lower())
+    return sorted(names)
+
+
+def record(fixture_dir, recipes_path):
+    """Capture fixtures from the live APIs."""
+    from context import current
+
+    ctx = current()
+    save_fixture(
+        fixture_dir,
+        "bliz_auctions",
+        ctx.blizzard_dynamic.request(
+            "GET",
+            (
+                f"/data/wow/connected-realm/{config.blizzard_realm_id}"
+                f"/auctions/{config.blizzard_ah_id}"
+            ),
+        ).json(),
+    )
+    save_fixture(
+        fixture_dir,
+        "tsm_ah",
+        ctx.price_api.request("GET", f"/ah/{config.tsm_ah_id}").json(),
+    )
+    save_fixture(
+        fixture_dir,
+        "tsm_region",
+        ctx.price_api.request("GET", f"/region/{config.tsm_region_id}").json(),
+    )
+    names = recipe_item_names(recipes_path)
+    ids = ctx.items.get_multiple_ids(names)
+    save_fixture(fixture_dir, "items", dict(zip(names, ids)))
+
+
+def synthesize(fixture_dir, recipes_path, num_filler_items=5000, seed=0):
+    """
+    Generate deterministic synthetic fixtures.
+
+    Every item in the recipe file gets an ID and some listings, and
+    `num_filler_items` extra items pad the payloads out to a realistic size.
+    """
+    rng = random.Random(seed)
+    names = recipe_item_names(recipes_path)
+    items = {name: 30000 + j for (j, name) in enumerate(names)}
+    all_ids = list(items.values()) + [
+        50000 + j for j in range(num_filler_items)
+    ]
+
+    auctions = []
+    tsm_ah = []
+    tsm_region = []
+    for item_id in all_ids:
+        base = int(rng.lognormvariate(10, 1.5)) + 1
+        quantity = 0
+        for _ in range(rng.randint(1, 40)):
+            stack = rng.choice([1, 1, 1, 5, 10, 20])
+            quantity += stack
+            auctions.append({
+                "id": len(auctions) + 1,
+                "item": {"id": item_id},
+                "buyout": int(base * rng.uniform(0.9, 2.0)),
+                "quantity": stack,
+            })
+        tsm_ah.append({
+            "auctionHouseId": config.tsm_ah_id,
+            "itemId": item_id,
+            "petSpeciesId": None,
+            "minBuyout": base,
+            "quantity": quantity,
+            "marketValue": int(base * 1.2),
+            "historical": int(base * 1.3),
+            "numAuctions": rng.randint(1, 40),
+        })
+        tsm_region.append({
+            "regionId": config.tsm_region_id,
+            "itemId": item_id,
+            "petSpeciesId": None,
+            "quantity": quantity * 20,
+            "marketValue": int(base * 1.25),
+            "historical": int(base * 1.3),
+            "avgSalePrice": int(base * 1.1),
+            # TSM reports this in tenths of a percent
+            "salePct": rng.randint(10, 900),
+            "soldPerDay": round(rng.uniform(0, 200), 3),
+        })
+
+    save_fixture(fixture_dir, "bliz_auctions", {"auctions": auctions})
+    save_fixture(fixture_dir, "tsm_ah", tsm_ah)
+    save_fixture(fixture_dir, "tsm_region", tsm_region)
+    save_fixture(fixture_dir, "items", items)
+
+
+#
+# Stand-in API server
+#
+
+
+class StandInServer:
+    """
+    Serve fixtures on the Blizzard and TSM API paths the code uses.
+
+    Both APIs are served from the same local address; the paths don't
+    overlap.
+    """
+
+    def __init__(self, fixture_dir):
+        self.bliz_auctions = load_fixture(fixture_dir, "bliz_auctions")
+        self.tsm_ah = load_fixture(fixture_dir, "tsm_ah")
+        self.tsm_region = load_fixture(fixture_dir, "tsm_region")
+        self.ids_by_name = load_fixture(fixture_dir, "items")
+        self.names_by_id = {v: k for (k, v) in self.ids_by_name.items()}
+        self.num_requests = 0
+        self._server = None
+        self._thread = None
+
+    def _item(self, item_id):
+        name = self.names_by_id.get(item_id, f"item {item_id}")
+        return {
+            "id": item_id,
+            "name": {"en_US": name},
+            "purchase_price": 100 * (item_id % 1000 + 1),
+        }
+
+    def route(self, path, query):
+        self.num_requests += 1
+        if re.fullmatch(r"/data/wow/connected-realm/\d+/auctions/\d+", path):
+            return self.bliz_auctions
+        elif path == "/data/wow/search/item":
+            name = query.get("name.en_US", [""])[0].lower()
+            results = (
+                [{"data": self._item(self.ids_by_name[name])}]
+                if name in self.ids_by_name else []
+            )
+            return {"pageCount": 1, "results": results}
+        elif match := re.fullmatch(r"/data/wow/item/(\d+)", path):
+            return self._item(int(match.group(1)))
+        elif re.fullmatch(r"/ah/\d+", path):
+            return self.tsm_ah
+        elif re.fullmatch(r"/region/\d+", path):
+            return self.tsm_region
+        else:
+            return None
+
+    def __enter__(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                data = stand_in.route(url.path, parse_qs(url.query))
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(404 if data is None else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def url(self):
+        (host, port) = self._server.server_address
+        return f"http://{host}:{port}"
+
+
+def stand_in_context(url, work_dir):
+    """An `AppContext` that talks to the stand-in and caches in `work_dir`."""
+    from blizzard import ItemLookup
+    from context import AppContext
+    from hxxp import Requester
+    from kvstore import InefficientKVStore
+    from snapshot import SnapshotProcessor
+    from tokens import ConstantHeader
+
+    token = ConstantHeader("Authorization", "Bearer benchmark")
+    ctx = AppContext(
+        blizzard_token=token,
+        tsm_token=token,
+        blizzard_static=Requester(
+            url,
+            token=token,
+            common_extra_headers={"Battlenet-Namespace": "static-classic-us"},
+        ),
+        blizzard_dynamic=Requester(
+            url,
+            token=token,
+            common_extra_headers={"Battlenet-Namespace": "dynamic-classic-us"},
+        ),
+        realm_api=Requester(url, token=token),
+        price_api=Requester(url, token=token),
+    )
+    ctx.tsm_region_snap = SnapshotProcessor(
+        ctx._tsm_region_snapper,
+        cache_dir=os.path.join(work_dir, "tsm-region"),
+    )
+    ctx.tsm_ah_snap = SnapshotProcessor(
+        ctx._tsm_ah_snapper,
+        cache_dir=os.path.join(work_dir, "ah"),
+    )
+    ctx.bliz_ah_snap = SnapshotProcessor(
+        ctx._bliz_ah_snapper,
+        cache_dir=os.path.join(work_dir, "bliz-ah"),
+    )
+    ctx.items = ItemLookup(
+        InefficientKVStore(os.path.join(work_dir, "item_ids.pkl")),
+        InefficientKVStore(os.path.join(work_dir, "item_names.pkl")),
+    )
+    return ctx
+
+
+#
+# Measuring
+#
+
+
+def measure(func, repeat=1):
+    """
+    Run `func` `repeat` times.
+
+    Return its last result, the fastest wall time and the largest peak of
+    memory allocated (as seen by `tracemalloc`) during a single run.
+    """
+    best = None
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            result = func()
+        finally:
+            elapsed = time.perf_counter() - start
+            (_, run_peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+        peak = max(peak, run_peak)
+    return (result, best, peak)
+
+
+def run_stages(fixture_dir, recipes_path, targets, repeat=3, k=5):
+    """Run every stage against the stand-in; return {stage: measurements}."""
+    from cytoolz import topk
+
+    import context
+    from blizzard import auction_data
+    from blizzard import auction_summary
+    from combined import dnf
+    from crafting import Recipes
+    from crafting import procurement_options
+    from crafting import top_procurement_options
+    from kvstore import InefficientKVStore
+    from procurement import PriceTable
+    from procurement import purchase_modes
+    from tsm import auction_house_snapshot
+
+    stages = {}
+
+    def stage(name, func, repeat=repeat):
+        (result, seconds, peak) = measure(func, repeat=repeat)
+        stages[name] = {"seconds": seconds, "peak_bytes": peak}
+        return result
+
+    def read_recipes():
+        with open(recipes_path) as f:
+            return Recipes(ctx.items).read_from_file(f)
+
+    previous_context = context.current()
+    with StandInServer(fixture_dir) as server, \
+            tempfile.TemporaryDirectory() as work_dir:
+        ctx = context.install(stand_in_context(server.url, work_dir))
+        try:
+            bliz_ah = stage(
+                "fetch_bliz_auctions",
+                lambda: auction_data(
+                    config.blizzard_realm_id,
+                    config.blizzard_ah_id,
+                ),
+            )
+            tsm_ah = stage(
+                "fetch_tsm_snapshot",
+                lambda: auction_house_snapshot(
+                    config.tsm_region_id,
+                    config.tsm_realm_id,
+                    config.tsm_ah_id,
+                ),
+            )
+            stage(
+                "auction_summary",
+                lambda: {k: auction_summary(v) for (k, v) in bliz_ah.items()},
+            )
+
+            # The first read resolves every name through the API; later
+            # reads are served by the item caches
+            stage("recipes_read_cold", read_recipes, repeat=1)
+            recipes = stage("recipes_read", read_recipes)
+
+            # Price through the real aggregator, but against the data we
+            # already fetched
+            from bliz_tsm_join import ItemInfoAggregator
+            ctx.aggregator = ItemInfoAggregator(
+                ctx.items,
+                bliz_ah,
+                tsm_ah,
+                InefficientKVStore(os.path.join(work_dir, "aggregator.pkl")),
+                ttl_seconds=float("inf"),
+            )
+
+            # Trees are memoized after the first build
+            def build_trees():
+                return [recipes.tree(recipes.ingredients(t)) for t in targets]
+
+            stage("recipes_tree_cold", build_trees, repeat=1)
+            trees = stage("recipes_tree", build_trees)
+            stage("dnf", lambda: [dnf(tree) for tree in trees])
+            # First pricing pass fills the aggregator store; time it cold
+            stage(
+                "procurement_options_cold",
+                lambda: [
+                    topk(
+                        k,
+                        procurement_options(purchase_modes, tree),
+                        key=lambda x: x[0],
+                    )
+                    for tree in trees
+                ],
+                repeat=1,
+            )
+            stage(
+                "procurement_options",
+                lambda: [
+                    topk(
+                        k,
+                        procurement_options(purchase_modes, tree),
+                        key=lambda x: x[0],
+                    )
+                    for tree in trees
+                ],
+            )
+
+            stage(
+                "top_procurement_options",
+                lambda: [
+                    top_procurement_options(
+                        PriceTable.for_tree(tree), tree, k,
+                    )
+                    for tree in trees
+                ],
+            )
+
+            store = InefficientKVStore(os.path.join(work_dir, "commit.pkl"))
+            summary = auction_summary(next(iter(bliz_ah.values())))
+            for item_id in tsm_ah:
+                store.put(item_id, {**summary, **tsm_ah[item_id]})
+            store.commit()
+
+            def commit_one():
+                store.put("benchmark", time.time())
+                store.commit()
+
+            stage("kvstore_commit", commit_one)
+        finally:
+            context.install(previous_context)
+
+        stages["_http_requests"] = server.num_requests
+
+    return stages
+
+
+#
+# Results
+#
+
+
+def code_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_results(results_path):
+    try:
+        with open(results_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def append_result(results_path, result):
+    with open(results_path, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+def compare(previous, result, threshold=0.1):
+    """
+    Yield (stage, metric, old, new, ratio, regressed) for each measurement.
+
+    A measurement regressed if it grew by more than `threshold` (a fraction).
+    """
+    for (name, new) in result["stages"].items():
+        old = previous["stages"].get(name)
+        if not isinstance(new, dict) or not isinstance(old, dict):
+            continue
+        for metric in ["seconds", "peak_bytes"]:
+            ratio = new[metric] / old[metric] if old[metric] else 1.0
+            yield (name, metric, old[metric], new[metric], ratio,
+                   ratio > 1 + threshold)
+
+
+def print_result(result, previous=None, threshold=0.1):
+    print(f"version {result['version']}  ({result['timestamp']})")
+    changes = {}
+    if previous:
+        print(f"compared to {previous['version']} ({previous['timestamp']})")
+        changes = {
+            (name, metric): (ratio, regressed)
+            for (name, metric, _, _, ratio, regressed)
+            in compare(previous, result, threshold=threshold)
+        }
+    for (name, data) in result["stages"].items():
+        if not isinstance(data, dict):
+            print(f"  {name: <26} {data}")
+            continue
+        line = (
+            f"  {name: <26} {data['seconds']*1000:10.2f} ms "
+            f"{data['peak_bytes']/2**20:10.2f} MiB"
+        )
+        for metric in ["seconds", "peak_bytes"]:
+            if (name, metric) in changes:
+                (ratio, regressed) = changes[(name, metric)]
+                flag = "  REGRESSED" if regressed else ""
+                line += f"  {metric}: x{ratio:.2f}{flag}"
+        print(line)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["run", "record", "synthesize"],
+        nargs="?",
+        default="run",
+    )
+    parser.add_argument("-f", "--fixtures", default="fixtures")
+    parser.add_argument("-r", "--recipes", default="recipes.txt")
+    parser.add_argument("-o", "--results", default="bench-results.jsonl")
+    parser.add_argument("-n", "--repeat", type=int, default=3)
+    parser.add_argument("-k", "--topk", type=int, default=5)
+    parser.add_argument("-t", "--target", action="append")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fractional slowdown reported as a regression",
+    )
+    parsed = parser.parse_args()
+
+    if parsed.command == "record":
+        record(parsed.fixtures, parsed.recipes)
+        return
+    elif parsed.command == "synthesize":
+        synthesize(parsed.fixtures, parsed.recipes)
+        return
+
+    if not have_fixtures(parsed.fixtures):
+        print(f"No fixtures in '{parsed.fixtures}', synthesizing them.")
+        synthesize(parsed.fixtures, parsed.recipes)
+
+    stages = run_stages(
+        parsed.fixtures,
+        parsed.recipes,
+        parsed.target or default_targets,
+        repeat=parsed.repeat,
+        k=parsed.topk,
+    )
+    result = {
+        "version": code_version(),
+        "timestamp": datetime.datetime.now().isoformat(),
+        "stages": stages,
+    }
+    previous = next(
+        (
+            r for r in reversed(load_results(parsed.results))
+            if r["version"] != result["version"]
+        ),
+        None,
+    )
+    append_result(parsed.results, result)
+    print_result(result, previous=previous, threshold=parsed.threshold)
+
+
+if __name__ == "__main__":
+    main()
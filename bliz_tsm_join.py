@@ -6,6 +6,7 @@ from blizzard import ItemLookup
 from blizzard import auction_data
 from blizzard import auction_summary
 from blizzard import collapse_languages
+from instrument import count
 from kvstore import InefficientKVStore
 from snapshot import SnapshotProcessor
 from tsm import auction_house_snapshot
@@ -78,6 +79,7 @@ class ItemInfoAggregator:
             not self.backing.get(item_id) or
             time.time() > self.backing.get(item_id)["_expiry_"]
         ):
+            count("aggregator.cache_misses")
             item_data = collapse_languages(self.items.get_item(item_id=item_id))
             bliz_data = auction_summary(self.bliz_ah.get(item_id))
             tsm_data = self.tsm_ah.get(item_id)
@@ -91,6 +93,8 @@ class ItemInfoAggregator:
                 },
             )
             self.backing.commit()
+        else:
+            count("aggregator.cache_hits")
         return self.backing.get(item_id)
 
     def get_property(
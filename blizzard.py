@@ -6,12 +6,11 @@ import pickle
 
 from cytoolz import groupby
 
+from context import current
 from hxxp import Requester
+from instrument import count
 from hxxp import DefaultHandlers
 from kvstore import InefficientKVStore
-from tokens import BlizzardToken
-from _keys import blizzard_client_id
-from _keys import blizzard_client_secret
 
 
 logging.basicConfig()
@@ -22,17 +21,20 @@ logger.setLevel(logging.DEBUG)
 _json = DefaultHandlers.raise_or_return_json
 
 
-blizzard_tok = BlizzardToken(blizzard_client_id, blizzard_client_secret)
-blizzard_static = Requester(
-    "https://us.api.blizzard.com",
-    token=blizzard_tok,
-    common_extra_headers={"Battlenet-Namespace": "static-classic-us"},
-)
-blizzard_dynamic = Requester(
-    "https://us.api.blizzard.com",
-    token=blizzard_tok,
-    common_extra_headers={"Battlenet-Namespace": "dynamic-classic-us"},
-)
+# The token and requesters live on the application context so they are only
+# built (and the credentials only imported) when first used.  These names are
+# still served from the module for existing callers.
+_context_attributes = {
+    "blizzard_tok": "blizzard_token",
+    "blizzard_static": "blizzard_static",
+    "blizzard_dynamic": "blizzard_dynamic",
+}
+
+
+def __getattr__(name):
+    if name in _context_attributes:
+        return getattr(current(), _context_attributes[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def _normalize_name(name):
@@ -70,7 +72,7 @@ def item_id(item):
 
 def item_search_by_name(terms):
     return _paginate(
-        blizzard_static,
+        current().blizzard_static,
         "/data/wow/search/item",
         subkey="results",
         params={"name.en_US": terms},
@@ -155,7 +157,7 @@ def item_search_id_by_name(terms):
 
 def item_query(query):
     return _paginate(
-        blizzard_static,
+        current().blizzard_static,
         "/data/wow/search/item",
         subkey="results",
         params=query,
@@ -164,7 +166,7 @@ def item_query(query):
 
 def auction_data(blizzard_realm_id, blizzard_ah_id):
     res = _json(
-        blizzard_dynamic.request(
+        current().blizzard_dynamic.request(
             "GET",
             (
                 f"/data/wow/connected-realm/"
@@ -229,11 +231,20 @@ def auction_summary(auctions):
 
 class ItemLookup:
     
-    def __init__(self, cache: InefficientKVStore, reverse_cache: InefficientKVStore):
-        self.bliz = blizzard_static
+    def __init__(
+        self,
+        cache: InefficientKVStore,
+        reverse_cache: InefficientKVStore,
+        bliz: Requester = None,
+    ):
+        self._bliz = bliz
         self.cache = cache
         self.reverse_cache = reverse_cache
 
+    @property
+    def bliz(self):
+        return self._bliz or current().blizzard_static
+
     def stage(self, id_, name):
         self.cache.put(id_, name)
         self.reverse_cache.put(_normalize_name(name), id_)
@@ -243,7 +254,9 @@ class ItemLookup:
         self.reverse_cache.commit()
     
     def get_name(self, id_):
+        count("items.name_lookups")
         if self.cache.get(id_) is None:
+            count("items.cache_misses")
             self.stage(id_, self._name_from_id_api(id_))
             self.commit()
         return self.cache.get(id_)
@@ -263,7 +276,9 @@ class ItemLookup:
 
     def get_id(self, name):
         norm_name = _normalize_name(name)
+        count("items.id_lookups")
         if self.reverse_cache.get(norm_name) is None:
+            count("items.cache_misses")
             item_id = item_search_single_id_by_name(norm_name)
             self.stage(item_id, norm_name)
             self.commit()
@@ -1,10 +1,35 @@
 import itertools
+import weakref
+
+from instrument import timed
 
 
 class Combined:
+    """
+    An And/Or node over `items`.
+
+    Nodes are hash-consed: constructing one with the same class and items as
+    a live node returns that node.  Identical subtrees are therefore shared,
+    and equality and hashing are by identity.
+    """
+
+    __slots__ = ("items", "__weakref__")
 
-    def __init__(self, *items):
-        self.items = items
+    # (class, items) -> the node
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, *items):
+        key = (cls, items)
+        node = Combined._interned.get(key)
+        if node is None:
+            node = super().__new__(cls)
+            node.items = items
+            Combined._interned[key] = node
+        return node
+
+    def __reduce__(self):
+        # Unpickling goes through __new__, so it is interned again
+        return (self.__class__, self.items)
 
     def __repr__(self):
         if self.items:
@@ -15,9 +40,6 @@ class Combined:
     def __iter__(self):
         return iter(self.items)
 
-    def __eq__(self, other):
-        return self.items == other.items
-
     def __getitem__(self, key):
         return self.items[key]
 
@@ -34,20 +56,21 @@ class Combined:
 
 
 class Impossible_(Combined):
-    pass
+    __slots__ = ()
 
 
 Impossible = Impossible_()
 
 
 class Empty_(Combined):
-    pass
+    __slots__ = ()
 
 
 Empty = Empty_()
 
 
 class Or(Combined):
+    __slots__ = ()
 
     def reduced(self):
         return Or.flat(
@@ -57,6 +80,7 @@ class Or(Combined):
 
 
 class And(Combined):
+    __slots__ = ()
 
     def reduced(self):
         if any(x is Impossible or x is Empty for x in self.items):
@@ -65,6 +89,7 @@ class And(Combined):
             return self
 
 
+@timed("dnf")
 def dnf(tree):
     if isinstance(tree, Or):
         return Or.flat(dnf(x) for x in tree.items)
@@ -1,9 +1,40 @@
+import os
+
 tsm_region_id = 13  # North America BCC
 tsm_realm_id = 762  # Eranikus
 tsm_ah_id = 471     # Eranikus - Alliance AH
 tsm_cache_dir = "ah"
+# TSM region stats are shared by every AH in the region and change slowly, so
+# they are snapshotted on their own and refreshed less often
+tsm_region_cache_dir = "tsm-region"
+tsm_region_max_age_seconds = 3600
 blizzard_realm_id = 4800  # US - Eranikus
 blizzard_ah_id = 2  # Alliance AH
 blizzard_item_cache = "item_ids.pkl"
 blizzard_item_reverse_cache = "item_names.pkl"
 blizzard_cache_dir = "bliz-ah"
+# Every realm / auction house we scan.  The first target is the "home" one
+# described by the settings above; the others keep their snapshots in
+# "<cache dir>-<name>".  Blizzard AH IDs are 2 (Alliance), 6 (Horde) and 7
+# (neutral); TSM AH IDs come from the realm API.
+targets = [
+    {
+        "name": "eranikus-alliance",
+        "tsm_region_id": tsm_region_id,
+        "tsm_realm_id": tsm_realm_id,
+        "tsm_ah_id": tsm_ah_id,
+        "blizzard_realm_id": blizzard_realm_id,
+        "blizzard_ah_id": blizzard_ah_id,
+    },
+]
+# Shared request rates for the APIs across all threads of a process
+blizzard_requests_per_second = 90
+tsm_requests_per_second = 2
+# Where OAuth tokens are shared between processes (None to keep them in memory)
+token_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "wow-scripts")
+# On-disk HTTP cache for static Blizzard data (None to disable), and how long
+# responses without a Cache-Control header stay fresh there
+http_cache_dir = "http-cache"
+http_cache_max_age = 24 * 3600
+# Share of a sale the auction house keeps
+ah_cut = 0.05
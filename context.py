@@ -0,0 +1,305 @@
+"""
+The application context: clients, snapshots and stores, built on first use.
+
+Nothing here does any work at import time.  Each attribute of `AppContext` is
+constructed (and its module imported) the first time it is accessed, so a
+script only pays for -- and only touches the network for -- what it actually
+uses.
+
+Most code should use the shared context returned by `current()`.  Notebooks
+and tests can swap in a differently configured one with `install()`.
+"""
+from functools import cached_property
+from functools import partial
+
+import config
+
+
+class AppContext:
+
+    def __init__(self, **overrides):
+        """
+        Initialize the instance.
+
+        Keyword arguments replace the attributes of the same name, e.g.
+        `AppContext(blizzard_token=ConstantHeader(...))`.  `cached_property`
+        keeps its values in the instance dict, so seeding the dict is all it
+        takes.
+        """
+        self.__dict__.update(overrides)
+
+    #
+    # Blizzard
+    #
+
+    @cached_property
+    def blizzard_token(self):
+        from _keys import blizzard_client_id
+        from _keys import blizzard_client_secret
+        from tokens import BlizzardToken
+        from tokens import TokenCache
+
+        return BlizzardToken(
+            blizzard_client_id,
+            blizzard_client_secret,
+            cache=(
+                TokenCache.for_credentials(
+                    config.token_cache_dir, "blizzard", blizzard_client_id,
+                )
+                if config.token_cache_dir else None
+            ),
+        )
+
+    @cached_property
+    def blizzard_rate_limiter(self):
+        from hxxp import RateLimiter
+
+        return RateLimiter(config.blizzard_requests_per_second)
+
+    @cached_property
+    def http_cache(self):
+        from hxxp import HttpCache
+
+        if not config.http_cache_dir:
+            return None
+        return HttpCache(
+            config.http_cache_dir,
+            default_max_age=config.http_cache_max_age,
+        )
+
+    @cached_property
+    def blizzard_static(self):
+        from hxxp import Requester
+
+        # Static-namespace data (items, item search) hardly ever changes, so
+        # it is worth caching; the dynamic namespace is not
+        return Requester(
+            "https://us.api.blizzard.com",
+            token=self.blizzard_token,
+            common_extra_headers={"Battlenet-Namespace": "static-classic-us"},
+            cache=self.http_cache,
+            rate_limiter=self.blizzard_rate_limiter,
+        )
+
+    @cached_property
+    def blizzard_dynamic(self):
+        from hxxp import Requester
+
+        return Requester(
+            "https://us.api.blizzard.com",
+            token=self.blizzard_token,
+            common_extra_headers={"Battlenet-Namespace": "dynamic-classic-us"},
+            rate_limiter=self.blizzard_rate_limiter,
+        )
+
+    #
+    # TSM
+    #
+
+    @cached_property
+    def tsm_token(self):
+        from _keys import tsm_key
+        from tokens import TSMToken
+        from tokens import TokenCache
+
+        return TSMToken(
+            tsm_key,
+            cache=(
+                TokenCache.for_credentials(config.token_cache_dir, "tsm", tsm_key)
+                if config.token_cache_dir else None
+            ),
+        )
+
+    @cached_property
+    def tsm_rate_limiter(self):
+        from hxxp import RateLimiter
+
+        return RateLimiter(config.tsm_requests_per_second)
+
+    @cached_property
+    def realm_api(self):
+        from hxxp import Requester
+
+        return Requester(
+            "https://realm-api.tradeskillmaster.com",
+            token=self.tsm_token,
+            rate_limiter=self.tsm_rate_limiter,
+        )
+
+    @cached_property
+    def price_api(self):
+        from hxxp import Requester
+
+        return Requester(
+            "https://pricing-api.tradeskillmaster.com",
+            token=self.tsm_token,
+            rate_limiter=self.tsm_rate_limiter,
+        )
+
+    #
+    # Stores
+    #
+
+    @cached_property
+    def items(self):
+        from blizzard import ItemLookup
+        from kvstore import InefficientKVStore
+
+        return ItemLookup(
+            InefficientKVStore(config.blizzard_item_cache),
+            InefficientKVStore(config.blizzard_item_reverse_cache),
+        )
+
+    @cached_property
+    def recipes(self):
+        """An empty `Recipes`; fill it with `read_from_file`."""
+        from crafting import Recipes
+
+        return Recipes(self.items)
+
+    #
+    # Snapshots
+    #
+
+    def _tsm_region_snapper(self):
+        from tsm import region_snapshot
+
+        return region_snapshot(config.tsm_region_id)
+
+    def _tsm_ah_snapper(self):
+        from tsm import auction_house_snapshot
+
+        return auction_house_snapshot(
+            config.tsm_region_id,
+            config.tsm_realm_id,
+            config.tsm_ah_id,
+            region=self.tsm_region,
+        )
+
+    def _bliz_ah_snapper(self):
+        from blizzard import auction_data
+
+        return auction_data(config.blizzard_realm_id, config.blizzard_ah_id)
+
+    @cached_property
+    def tsm_region_snap(self):
+        from snapshot import SnapshotProcessor
+
+        return SnapshotProcessor(
+            self._tsm_region_snapper,
+            cache_dir=config.tsm_region_cache_dir,
+        )
+
+    @cached_property
+    def _tsm_region_snaps(self):
+        # region ID -> stream, for regions other than the home one
+        return {}
+
+    def tsm_region_stream(self, region_id):
+        """The TSM region snapshot stream of `region_id`."""
+        from snapshot import SnapshotProcessor
+        from tsm import region_snapshot
+
+        if region_id == config.tsm_region_id:
+            return self.tsm_region_snap
+        if region_id not in self._tsm_region_snaps:
+            self._tsm_region_snaps[region_id] = SnapshotProcessor(
+                partial(region_snapshot, region_id),
+                cache_dir=f"{config.tsm_region_cache_dir}-{region_id}",
+            )
+        return self._tsm_region_snaps[region_id]
+
+    @cached_property
+    def tsm_ah_snap(self):
+        from snapshot import SnapshotProcessor
+
+        return SnapshotProcessor(
+            self._tsm_ah_snapper,
+            cache_dir=config.tsm_cache_dir,
+        )
+
+    @cached_property
+    def bliz_ah_snap(self):
+        from snapshot import SnapshotProcessor
+
+        return SnapshotProcessor(
+            self._bliz_ah_snapper,
+            cache_dir=config.blizzard_cache_dir,
+        )
+
+    @property
+    def tsm_region(self):
+        return self.tsm_region_snap.get(
+            max_age_seconds=config.tsm_region_max_age_seconds,
+        )
+
+    @property
+    def tsm_ah(self):
+        return self.tsm_ah_snap.get(max_age_seconds=3000)
+
+    @property
+    def bliz_ah(self):
+        return self.bliz_ah_snap.get(max_age_seconds=3000)
+
+    @property
+    def order_books(self):
+        """An `OrderBookIndex` of the aggregator's Blizzard snapshot."""
+        from orderbook import OrderBookIndex
+
+        # Same listings the aggregator's "min" etc. are computed from
+        bliz_ah = self.aggregator.bliz_ah
+        books = self.__dict__.get("_order_books")
+        # Built once per snapshot
+        if books is None or books.snapshot is not bliz_ah:
+            books = self._order_books = OrderBookIndex(bliz_ah)
+        return books
+
+    @cached_property
+    def realm_scanner(self):
+        """Snapshot streams and a cross-realm index for `config.targets`."""
+        from realms import RealmScanner
+        from realms import configured_targets
+        from realms import target_streams
+
+        targets = configured_targets()
+        streams = {
+            target.name: (
+                (self.bliz_ah_snap, self.tsm_ah_snap) if j == 0
+                else target_streams(
+                    target,
+                    self.tsm_region_stream(target.tsm_region_id),
+                )
+            )
+            for (j, target) in enumerate(targets)
+        }
+        return RealmScanner(targets, streams)
+
+    @cached_property
+    def aggregator(self):
+        from bliz_tsm_join import ItemInfoAggregator
+        from kvstore import InefficientKVStore
+
+        return ItemInfoAggregator(
+            self.items,
+            self.bliz_ah,
+            self.tsm_ah,
+            InefficientKVStore("aggregator.pkl"),
+        )
+
+
+_current = None
+
+
+def current() -> AppContext:
+    """Return the shared context, creating it if needed."""
+    global _current
+    if _current is None:
+        _current = AppContext()
+    return _current
+
+
+def install(context: AppContext) -> AppContext:
+    """Make `context` the shared context and return it."""
+    global _current
+    _current = context
+    return context
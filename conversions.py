@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Conversion arbitrage driven by the recipe graph.
+
+`elemental_arbitrage` compares hand-picked pairs (eternal vs crystallized,
+greater vs lesser essence, ...).  Those conversions are already recipes in
+`recipes.txt`, along with every other transform we know about, so here we
+compile a `Recipes` into matrices once and evaluate all of them against each
+new TSM snapshot in a single batch:
+
+- one-step transforms: buy a recipe's reagents, craft, sell the outputs;
+- conversion cycles: chains of one-reagent recipes that end where they start
+  with more units than they began with.
+
+Opportunities are sized the way `elemental_arbitrage.arbitrage` sizes them:
+by the headroom of the item being sold and its sale rate.
+"""
+import math
+
+import numpy as np
+
+from crafting import Recipes
+from elemental_arbitrage import region_stats
+from elemental_arbitrage import statuses
+
+
+class RecipeMatrices:
+    """
+    The recipe graph as dense matrices.
+
+    `produced[r, i]` and `consumed[r, i]` are the number of item `i` that
+    recipe `r` makes and uses; `item_ids[i]` and `names[i]` identify the
+    columns and `recipe_ids[r]` the rows.
+    """
+
+    def __init__(self, recipes: Recipes):
+        self.recipe_ids = list(recipes.storage)
+        names = {}
+        for (outputs, inputs) in recipes.storage.values():
+            for vector in (outputs, inputs):
+                for (name, _, item_id) in vector.triples():
+                    names[item_id] = name
+        self.item_ids = list(names)
+        self.names = [names[i] for i in self.item_ids]
+        column = {item_id: j for (j, item_id) in enumerate(self.item_ids)}
+
+        shape = (len(self.recipe_ids), len(self.item_ids))
+        self.produced = np.zeros(shape)
+        self.consumed = np.zeros(shape)
+        for (r, recipe_id) in enumerate(self.recipe_ids):
+            (outputs, inputs) = recipes.storage[recipe_id]
+            for (_, count, item_id) in outputs.triples():
+                self.produced[r, column[item_id]] += count
+            for (_, count, item_id) in inputs.triples():
+                self.consumed[r, column[item_id]] += count
+
+    def describe(self, r):
+        def _side(row):
+            return " + ".join(
+                f"{int(n) if n == int(n) else n} {self.names[j]}"
+                for j in np.flatnonzero(row)
+                for n in [row[j]]
+            )
+        return f"{_side(self.consumed[r])} -> {_side(self.produced[r])}"
+
+
+class ConversionArbitrage:
+    """
+    Evaluate every conversion in a `Recipes` against TSM snapshots.
+
+    Compile once with the recipes; then call `evaluate(tsm_ah)` per snapshot,
+    or `attach` to a `SnapshotProcessor` to have it done on every refresh
+    (the latest results are kept in `results`).
+    """
+
+    def __init__(self, recipes: Recipes, price_param="marketValue",
+                 max_cycle_length=4):
+        self.matrices = RecipeMatrices(recipes)
+        self.price_param = price_param
+        self.cycles = list(self._conversion_cycles(max_cycle_length))
+        self.results = None
+
+    def _conversion_cycles(self, max_length):
+        """
+        Yield (recipe rows, yield) for cycles of one-reagent, one-product
+        recipes whose yield -- units of the starting item we end up with per
+        unit put in -- is above 1.
+
+        These don't depend on prices, so they're found once at compile time.
+        """
+        m = self.matrices
+        edges = {}
+        for r in range(len(m.recipe_ids)):
+            ins = np.flatnonzero(m.consumed[r])
+            outs = np.flatnonzero(m.produced[r])
+            if len(ins) == 1 and len(outs) == 1 and ins[0] != outs[0]:
+                (a, b) = (int(ins[0]), int(outs[0]))
+                rate = float(m.produced[r, b] / m.consumed[r, a])
+                edges.setdefault(a, []).append((b, r, rate))
+
+        def _walk(start, node, path, rate):
+            for (nxt, r, edge_rate) in edges.get(node, []):
+                if nxt == start:
+                    if rate * edge_rate > 1 + 1e-9:
+                        yield (path + [r], rate * edge_rate)
+                # Only walk through nodes after `start` so each cycle is
+                # found once, from its smallest node
+                elif nxt > start and len(path) + 1 < max_length and not any(
+                    m.consumed[p, nxt] for p in path
+                ):
+                    yield from _walk(start, nxt, path + [r], rate * edge_rate)
+
+        for start in sorted(edges):
+            yield from _walk(start, start, [], 1.0)
+
+    def _columns(self, tsm_ah):
+        """Per-item price, headroom and sale rate arrays from a snapshot."""
+        m = self.matrices
+        price = np.full(len(m.item_ids), np.nan)
+        room = np.full(len(m.item_ids), np.nan)
+        sale_rate = np.full(len(m.item_ids), np.nan)
+        for (j, item_id) in enumerate(m.item_ids):
+            record = tsm_ah.get(item_id)
+            if record is None:
+                continue
+            region = region_stats(record)
+            price[j] = record.get(self.price_param) or np.nan
+            if region.get("salePct"):
+                sale_rate[j] = region["salePct"] / 100
+                room[j] = region["soldPerDay"] / sale_rate[j] - record["quantity"]
+        return (price, room, sale_rate)
+
+    def evaluate(self, tsm_ah):
+        """
+        Price every transform and cycle; return them best first.
+
+        Each result is a dict with `execute` (a `statuses` label, or "no"),
+        `kind`, `description`, `unit_profit` (per craft, or per unit cycled),
+        `headroom` of what is sold and `saturated_profit`.
+        """
+        m = self.matrices
+        (price, room, sale_rate) = self._columns(tsm_ah)
+
+        # One-step transforms
+        with np.errstate(invalid="ignore"):
+            value = (m.produced * price).sum(axis=1, where=m.produced > 0)
+            cost = (m.consumed * price).sum(axis=1, where=m.consumed > 0)
+            # Any reagent or product without a price makes the recipe unpriced
+            priced = ~(
+                ((m.produced > 0) | (m.consumed > 0)) & np.isnan(price)
+            ).any(axis=1)
+            unit_profit = np.where(priced, value - cost, np.nan)
+            # Size by the product we make the most value from
+            main = np.argmax(np.nan_to_num(m.produced * price), axis=1)
+            rows = np.arange(len(main))
+            main_count = m.produced[rows, main]
+            main_room = room[main]
+            saturated = np.where(
+                (main_room > 0) & (unit_profit > 0),
+                main_room * sale_rate[main] * unit_profit / main_count,
+                0.0,
+            )
+        saturated = np.nan_to_num(saturated)
+
+        results = [
+            {
+                "kind": "transform",
+                "description": m.describe(r),
+                "unit_profit": float(unit_profit[r]),
+                "headroom": float(main_room[r]),
+                "saturated_profit": float(saturated[r]),
+            }
+            for r in np.flatnonzero(priced)
+        ]
+
+        # Cycles: sell the extra units of the starting item
+        for (path, cycle_yield) in self.cycles:
+            start = int(np.flatnonzero(m.consumed[path[0]])[0])
+            if np.isnan(price[start]):
+                continue
+            extra = cycle_yield - 1
+            unit = extra * price[start]
+            results.append({
+                "kind": "cycle",
+                "description": " / ".join(m.describe(r) for r in path),
+                "unit_profit": float(unit),
+                "headroom": float(room[start]),
+                "saturated_profit": (
+                    float(room[start] * sale_rate[start] * unit)
+                    if room[start] > 0 else 0.0
+                ),
+            })
+
+        for result in results:
+            result["execute"] = next(
+                (
+                    name for (profit, name) in statuses
+                    if result["saturated_profit"] > profit
+                ),
+                "no",
+            )
+        results.sort(key=lambda x: -x["saturated_profit"])
+        self.results = results
+        return results
+
+    def attach(self, snapshot_processor):
+        """Re-evaluate whenever `snapshot_processor` gets a new snapshot."""
+        return snapshot_processor.subscribe(self.evaluate)
+
+
+def summary(result):
+    # Unknown for items without region sale stats
+    headroom = (
+        "?" if math.isnan(result["headroom"]) else int(result["headroom"])
+    )
+    return " ".join([
+        f"{result['execute'].upper(): <12}",
+        f"{result['kind']: <10}",
+        f"{result['description']}",
+        f"(unit profit: {result['unit_profit']}, "
+        f"headroom: {headroom})",
+    ])
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Rank conversions in the recipe file against TSM prices",
+    )
+    parser.add_argument("-r", "--recipes", default="recipes.txt")
+    parser.add_argument("-k", "--topk", type=int, default=20)
+    parser.add_argument("-p", "--price-param", default="marketValue")
+    parsed = parser.parse_args()
+
+    from context import current
+
+    ctx = current()
+    with open(parsed.recipes) as f:
+        ctx.recipes.read_from_file(f)
+    engine = ConversionArbitrage(ctx.recipes, price_param=parsed.price_param)
+    for result in engine.evaluate(ctx.tsm_ah)[:parsed.topk]:
+        print(summary(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,20 @@
-import uuid
+import heapq
+import math
+import os
 import re
+import threading
+import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 
 from combined import And, Or, Empty, Impossible
 from combined import dnf
 from formal_vector import FormalVector
 from kvstore import InefficientKVStore
 from blizzard import ItemLookup
+from instrument import count
+from instrument import span
+from instrument import timed
 
 
 class CraftingComponents(FormalVector):
@@ -19,34 +28,77 @@ class CraftingComponents(FormalVector):
         return list(set(self.basis.keys()))
 
 
-class Procure:
+class _Op:
+    """
+    Base of `Procure` and `Craft`.
+
+    Like the `combined` nodes, ops are hash-consed: there is one live op per
+    class and item (see `FormalVector.key`), compared and hashed by
+    identity.
+    """
+
+    __slots__ = ("item", "__weakref__")
+
+    # (class, item key) -> the op
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, item: CraftingComponents):
+        key = (cls, item.key())
+        op = _Op._interned.get(key)
+        if op is None:
+            op = super().__new__(cls)
+            op.item = item
+            _Op._interned[key] = op
+        return op
 
-    def __init__(self, item: CraftingComponents):
-        self.item = item
+    def __reduce__(self):
+        return (self.__class__, (self.item,))
+
+
+class Procure(_Op):
+    __slots__ = ()
 
     def __repr__(self):
         return f"Procure({self.item})"
 
 
+def _specific_procure(name, item):
+    op = object.__new__(SpecificProcure)
+    op.name = name
+    op.item = item
+    return op
+
+
 class SpecificProcure(Procure):
+    # Made per priced plan, so these aren't interned
+
+    __slots__ = ("name",)
 
-    def __init__(self, name, item: CraftingComponents):
-        self.name = "".join(c.title() for c in name.split())
-        self.item = item
+    def __new__(cls, name, item: CraftingComponents):
+        return _specific_procure("".join(c.title() for c in name.split()), item)
+
+    def __reduce__(self):
+        return (_specific_procure, (self.name, self.item))
 
     def __repr__(self):
         return f"{self.name}({self.item})"
 
 
-class Craft:
-
-    def __init__(self, item: CraftingComponents):
-        self.item = item
+class Craft(_Op):
+    __slots__ = ()
 
     def __repr__(self):
         return f"Craft({self.item})"
 
 
+def _recipe_key(outputs, inputs):
+    """What a recipe makes and uses, by item ID, as a hashable key."""
+    return (
+        frozenset((item_id, n) for (_, n, item_id) in outputs.triples()),
+        frozenset((item_id, n) for (_, n, item_id) in inputs.triples()),
+    )
+
+
 class Recipes:
 
     def __init__(self, items: ItemLookup):
@@ -54,18 +106,85 @@ class Recipes:
         self.storage = {}
         self.in_index = {}
         self.out_index = {}
-
-    def read_from_file(self, f):
+        # Recipe content key -> recipe IDs, so a reload can tell which
+        # recipes are new and which are gone
+        self._by_key = {}
+        # Ingredient string -> CraftingComponents, so names are only resolved
+        # the first time they are seen
+        self._parsed = {}
+        # (count, item_id) -> (tree, IDs of the items it depends on)
+        self._trees = {}
+        self._subscribers = []
+        self._lock = threading.RLock()
+
+    def _read_pairs(self, f):
+        """Yield the (outputs, inputs) strings of each recipe in `f`."""
         r_out = None
         for line in f:
             if line.strip() and not line.strip().startswith("#"):
                 if r_out:
-                    self.recipe_from_strings(r_out, line.strip())
+                    yield (r_out, line.strip())
                     r_out = None
                 else:
                     r_out = line.strip()
+
+    def read_from_file(self, f):
+        with span("recipes.parse"):
+            for (outs, ins) in self._read_pairs(f):
+                self.recipe_from_strings(outs, ins)
         return self
 
+    def reload_from_file(self, f):
+        """
+        Make the recipes match those in `f`, touching only what changed.
+
+        Recipes are matched by content; ones no longer in the file are
+        removed and new ones added, and only the trees that involve their
+        products are dropped.  Subscribers are called with the IDs of the
+        items whose recipes changed, which are also returned.
+        """
+        with self._lock, span("recipes.reload"):
+            wanted = {}
+            for (outs, ins) in self._read_pairs(f):
+                outputs = self.ingredients(outs)
+                inputs = self.ingredients(ins)
+                wanted.setdefault(_recipe_key(outputs, inputs), []).append(
+                    (outputs, inputs)
+                )
+
+            changed = set()
+            for (key, ids) in list(self._by_key.items()):
+                for id_ in ids[len(wanted.get(key, [])):]:
+                    changed.update(self.remove_recipe(id_)[0].basis.values())
+            for (key, recipes) in wanted.items():
+                have = len(self._by_key.get(key, []))
+                for (outputs, inputs) in recipes[have:]:
+                    self.recipe(outputs, inputs)
+                    changed.update(outputs.basis.values())
+
+        if changed:
+            for callback in self._subscribers:
+                callback(changed)
+        return changed
+
+    def subscribe(self, callback):
+        """
+        Call `callback(item_ids)` after a reload changes the recipes of those
+        items.  Returns `callback`.
+        """
+        self._subscribers.append(callback)
+        return callback
+
+    def watch(self, path, interval=2.0):
+        """Reload from `path` whenever it changes; returns the `FileWatcher`."""
+        from filewatch import FileWatcher
+
+        def _reload(path):
+            with open(path) as f:
+                self.reload_from_file(f)
+
+        return FileWatcher(path, _reload, interval=interval).start()
+
     def ingredient(self, item_name=None, item_id=None):
         if item_name is not None:
             item_id = self.items.get_id(item_name)
@@ -92,16 +211,49 @@ class Recipes:
         else:
             raise TypeError("Must provide item, item_id, or item_name")
 
+    def _invalidate(self, item_ids):
+        """Forget the trees that involve any of `item_ids`."""
+        for (key, (_, depends)) in list(self._trees.items()):
+            if not depends.isdisjoint(item_ids):
+                del self._trees[key]
+
     def recipe(self, outputs, inputs):
         id_ = uuid.uuid4()
         self.storage[id_] = (outputs, inputs)
+        self._by_key.setdefault(_recipe_key(outputs, inputs), []).append(id_)
         for inp in inputs.basis.values():
             self.in_index[inp] = self.in_index.get(inp, []) + [id_]
         for outp in outputs.basis.values():
             self.out_index[outp] = self.out_index.get(outp, []) + [id_]
+        self._invalidate(outputs.basis.values())
         return (id_, outputs, inputs)
 
+    def remove_recipe(self, id_):
+        """Remove the recipe `id_`; return its (outputs, inputs)."""
+        (outputs, inputs) = self.storage.pop(id_)
+        key = _recipe_key(outputs, inputs)
+        self._by_key[key].remove(id_)
+        if not self._by_key[key]:
+            del self._by_key[key]
+        for (index, vector) in [
+            (self.in_index, inputs),
+            (self.out_index, outputs),
+        ]:
+            for item_id in vector.basis.values():
+                ids = [x for x in index.get(item_id, []) if x != id_]
+                if ids:
+                    index[item_id] = ids
+                else:
+                    index.pop(item_id, None)
+        self._invalidate(outputs.basis.values())
+        return (outputs, inputs)
+
     def ingredients(self, s):
+        if s not in self._parsed:
+            self._parsed[s] = self._parse_ingredients(s)
+        return self._parsed[s]
+
+    def _parse_ingredients(self, s):
         components = [
             re.search(r"(\d+)?\s*[*]?\s*(.*)", y.strip()).groups()
             for y in re.split(r"\s*[+]\s*", s)
@@ -124,15 +276,39 @@ class Recipes:
     def recipe_from_strings(self, outs, ins):
         return self.recipe(self.ingredients(outs), self.ingredients(ins))
 
+    @timed("recipes.tree")
     def tree(self, item: CraftingComponents, path=None):
-        path = path or []
+        """
+        The tree of ways to get `item`.
+
+        Trees of single items are memoized until the recipes of an item in
+        them change.
+        """
+        if path or len(item.components) > 1:
+            return self._tree(item, path or [], set())
+
+        (_, n, item_id) = item.pure()
+        with self._lock:
+            if (n, item_id) in self._trees:
+                count("recipes.tree_memo_hits")
+            else:
+                depends = set()
+                self._trees[(n, item_id)] = (
+                    self._tree(item, [], depends),
+                    depends,
+                )
+            return self._trees[(n, item_id)][0]
 
+    def _tree(self, item: CraftingComponents, path, depends):
+        # `depends` collects the IDs of every item whose recipes were looked
+        # up, i.e. whose recipe changes would change the result
         if len(item.components) > 1:
             return And.flat(
                 self.tree(item.project(k)) for k in item.components
             )
 
         (name, count, item_id) = item.pure()
+        depends.add(item_id)
 
         # We track which items we are crafting in this branch of the tree so
         # we can quit if we end up in a loop
@@ -158,7 +334,11 @@ class Recipes:
                 And(
                     Craft(item),
                     And.flat(
-                        self.tree(recipe.project(ingredient), path=path + [item_id])
+                        self._tree(
+                            recipe.project(ingredient),
+                            path + [item_id],
+                            depends,
+                        )
                         for ingredient in recipe.components
                     ).reduced()
                 ).reduced()
@@ -177,7 +357,7 @@ def _coalesce(ops):
         
         if isinstance(op, (Craft, Procure)):
             k = op.item.pure()[-1]
-            if k in by_item:
+            if k in by_item[t]:
                 by_item[t][k] += op.item
             else:
                 by_item[t][k] = op.item
@@ -210,21 +390,245 @@ def _procure_decider(purchase_modes, item):
     )
 
 
-def procurement_options(purchase_modes, tree):
-    methods = (coalesce(x) for x in dnf(tree))
+def _price_method(purchase_modes, method):
+    method_cost = 0
+    method_result = []
+    for op in method:
+        if isinstance(op, Procure):
+            (op_cost, specific_op, options) = _procure_decider(purchase_modes, op.item)
+        else:
+            (op_cost, specific_op, options) = (0, op, [])
 
-    for method in methods:
+        method_cost += op_cost
+        method_result.append((op_cost, specific_op, options))
 
-        method_cost = 0
-        method_result = []
-        for op in method:
-            if isinstance(op, Procure):
-                (op_cost, specific_op, options) = _procure_decider(purchase_modes, op.item)
-            else:
-                (op_cost, specific_op, options) = (0, op, [])
+    return (method_cost, method_result)
+
+
+@timed("procurement_options")
+def procurement_options(purchase_modes, tree):
+    # Different plans often coalesce to the same ops; price each once
+    seen = set()
+    for plan in dnf(tree):
+        method = coalesce(plan)
+        key = frozenset(method)
+        if key in seen:
+            count("plans.duplicates")
+            continue
+        seen.add(key)
+        count("plans.enumerated")
+        yield _price_method(purchase_modes, method)
+
+
+def _plan_bounds(tree, unit_lower_bound):
+    """
+    {id(node): (lower bound on cost, number of plans)} for the nodes of
+    `tree`.
+
+    Costs here are positive (what is spent), and a plan's cost is bounded
+    by the sum over its `Procure` leaves of count times the item's lowest
+    possible unit price.  Coalescing only merges leaves, and the unit price
+    of a merged purchase is never below that, so the bound holds for every
+    plan a node leads to.
+    """
+    bounds = {}
+
+    def _visit(node):
+        if id(node) in bounds:
+            return bounds[id(node)]
+        if isinstance(node, Or):
+            children = [_visit(x) for x in node.items]
+            result = (
+                min(lb for (lb, _) in children),
+                sum(n for (_, n) in children),
+            )
+        elif isinstance(node, And):
+            children = [_visit(x) for x in node.items]
+            result = (
+                sum(lb for (lb, _) in children),
+                math.prod(n for (_, n) in children),
+            )
+        elif isinstance(node, Procure):
+            (_, n, item_id) = node.item.pure()
+            result = (n * unit_lower_bound(item_id), 1)
+        else:
+            result = (0, 1)
+        bounds[id(node)] = result
+        return result
+
+    _visit(tree)
+    return bounds
+
+
+def _branch_and_bound(purchase_modes, tree, k, start=0, stop=None):
+    """
+    The `k` best of plans `start` to `stop` of `dnf(tree)`, as (plan
+    index, key, `procurement_options` result), best first; and how many
+    plans were pruned.  Plans that coalesce to the same ops as an earlier
+    one (same key) are skipped.
+
+    Plans are enumerated depth first in `dnf` order, so the results (ties
+    included) are those of `topk` over `procurement_options`.  A branch is
+    cut as soon as its cost bound (see `_plan_bounds`; from
+    `purchase_modes.unit_lower_bound` if it has one, else 0) shows none of
+    its plans can beat the current k-th best.
+    """
+    unit_lower_bound = getattr(
+        purchase_modes, "unit_lower_bound", lambda item_id: 0,
+    )
+    bounds = _plan_bounds(tree, unit_lower_bound)
+    (tree_lb, num_plans) = bounds[id(tree)]
+    stop = num_plans if stop is None else stop
+
+    # Min-heap of the best plans so far as (cost, -index, key, result): its
+    # top is the k-th best, and of equal costs the later plan ranks lower
+    top = []
+    pruned = 0
+    # Keys of the coalesced plans priced so far
+    seen = set()
+    # Each frame is a set of plans: the index of the first one, the nodes
+    # still to expand and the leaves chosen so far (both as (head, tail)
+    # linked lists), the cost bounds of the chosen leaves and of the rest,
+    # and the number of plans
+    frames = [(0, (tree, None), None, 0, tree_lb, num_plans)]
+    while frames:
+        (index, nodes, leaves, leaves_lb, rest_lb, num) = frames.pop()
+        if index >= stop or index + num <= start:
+            continue
+
+        if len(top) == k:
+            best_possible = -(leaves_lb + rest_lb)
+            # Leave room for rounding, so a plan that ties is never cut
+            slack = 1e-9 * (abs(best_possible) + abs(top[0][0]) + 1)
+            if best_possible <= top[0][0] - slack:
+                pruned += min(index + num, stop) - max(index, start)
+                continue
+
+        if nodes is None:
+            plan = []
+            while leaves is not None:
+                (leaf, leaves) = leaves
+                plan.append(leaf)
+            plan.reverse()
+            method = coalesce(plan)
+            key = frozenset(method)
+            if key in seen:
+                count("plans.duplicates")
+                continue
+            seen.add(key)
+            count("plans.enumerated")
+            result = _price_method(purchase_modes, method)
+            entry = (result[0], -index, key, result)
+            if len(top) < k:
+                heapq.heappush(top, entry)
+            elif entry[:2] > top[0][:2]:
+                heapq.heapreplace(top, entry)
+            continue
+
+        (node, rest) = nodes
+        (node_lb, node_num) = bounds[id(node)]
+        rest_num = num // node_num
+        if isinstance(node, Or):
+            children = []
+            offset = index
+            for child in node.items:
+                (child_lb, child_num) = bounds[id(child)]
+                children.append((
+                    offset,
+                    (child, rest),
+                    leaves,
+                    leaves_lb,
+                    rest_lb - node_lb + child_lb,
+                    child_num * rest_num,
+                ))
+                offset += child_num * rest_num
+            # Popped in order
+            frames.extend(reversed(children))
+        elif isinstance(node, And):
+            for child in reversed(node.items):
+                rest = (child, rest)
+            frames.append((index, rest, leaves, leaves_lb, rest_lb, num))
+        else:
+            frames.append((
+                index,
+                rest,
+                (node, leaves),
+                leaves_lb + node_lb,
+                rest_lb - node_lb,
+                rest_num,
+            ))
+
+    top.sort(key=lambda x: x[:2], reverse=True)
+    return (
+        [(-neg_index, key, result) for (_, neg_index, key, result) in top],
+        pruned,
+    )
 
-            method_cost += op_cost
-            method_result.append((op_cost, specific_op, options))
-        
-        yield (method_cost, method_result)
 
+# Set in each worker process by `_init_worker`
+_worker_state = None
+
+
+def _init_worker(purchase_modes, tree):
+    global _worker_state
+    _worker_state = (purchase_modes, tree)
+
+
+def _top_of_chunk(args):
+    """`_branch_and_bound` over plans `start` to `stop`, in a worker."""
+    (k, start, stop) = args
+    (purchase_modes, tree) = _worker_state
+    return _branch_and_bound(purchase_modes, tree, k, start=start, stop=stop)
+
+
+def top_procurement_options(purchase_modes, tree, k, jobs=1, chunks_per_job=4):
+    """
+    The `k` best `procurement_options`, best first.
+
+    Plans are enumerated branch and bound (see `_branch_and_bound`), which
+    only cuts anything when `purchase_modes` has a `unit_lower_bound`, as
+    `procurement.PriceTable` does.  The number of plans cut is counted as
+    "plans.pruned".
+
+    With `jobs` > 1 the plans are split into ranges that that many worker
+    processes (None for one per core) search separately, each keeping its
+    own top `k`.  `purchase_modes` is sent to the workers, so it has to be
+    picklable.
+
+    Either way the result is what `topk` picks from `procurement_options`,
+    ties included.
+    """
+    if k <= 0:
+        return []
+    if jobs == 1:
+        (top, pruned) = _branch_and_bound(purchase_modes, tree, k)
+        count("plans.pruned", pruned)
+        return [result for (_, _, result) in top]
+
+    (_, num_plans) = _plan_bounds(tree, lambda item_id: 0)[id(tree)]
+    jobs = jobs or os.cpu_count()
+    chunk_size = max(1, -(-num_plans // (jobs * chunks_per_job)))
+    chunks = [
+        (k, start, min(start + chunk_size, num_plans))
+        for start in range(0, num_plans, chunk_size)
+    ]
+    candidates = []
+    with span("procurement_options.parallel"):
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(purchase_modes, tree),
+        ) as pool:
+            for (top, pruned) in pool.map(_top_of_chunk, chunks):
+                candidates.extend(top)
+                count("plans.pruned", pruned)
+    # Best first; of equal plans, the one `procurement_options` yields first
+    candidates.sort(key=lambda x: (-x[2][0], x[0]))
+    # A plan can turn up again in a later range
+    seen = set()
+    results = []
+    for (_, key, result) in candidates:
+        if key not in seen:
+            seen.add(key)
+            results.append(result)
+    return results[:k]
@@ -1,3 +1,8 @@
+import weakref
+
+import numpy as np
+
+
 eternals = {
     x.lower(): (f"Eternal {x}", f"Crystallized {x}")
     for x in ["Life", "Earth", "Air", "Fire", "Water", "Shadow"]
@@ -23,9 +28,16 @@ statuses = [
 ]
 
 
+def region_stats(item):
+    # Older snapshots nest the region stats under "region"; newer ones have
+    # them merged into the record
+    return item.get("region", item)
+
+
 def headroom(item):
+    region = region_stats(item)
     return (
-        item["region"]["soldPerDay"]/(item["region"]["salePct"]/100) -
+        region["soldPerDay"]/(region["salePct"]/100) -
         item["quantity"]
     )
 
@@ -45,8 +57,8 @@ def arbitrage(
     big_space = headroom(big)
     small_space = headroom(small)
     
-    profit_big = max(big_space*big["region"]["salePct"]/100*arb, 0)
-    profit_small = max(small_space*small["region"]["salePct"]/100*(-arb), 0)
+    profit_big = max(big_space*region_stats(big)["salePct"]/100*arb, 0)
+    profit_small = max(small_space*region_stats(small)["salePct"]/100*(-arb), 0)
 
     diagnostics = {
         "arb": arb,
@@ -110,12 +122,137 @@ def summary(name, arb, cutoff=2):
         return f"SKIP        {name}"
 
 
-def print_elemental_arbitrage_report(tsm_ah, items):
-    for (name, pair) in eternals.items():
-        print(summary(f"eternal-{name}", pair_arbitrage(tsm_ah, items, pair, 10), cutoff=2))
+# (report name, pair, multiplier, reverse_ok) for every pair in the report
+families = (
+    [(f"eternal-{name}", pair, 10, True) for (name, pair) in eternals.items()] +
+    [(f"primal-{name}", pair, 10, False) for (name, pair) in primals.items()] +
+    [(f"essence-{name}", pair, 3, True) for (name, pair) in essences.items()]
+)
+
+
+class ElementalReport:
+    """
+    `arbitrage` for every pair in `families` at once.
+
+    Item IDs are resolved once, when the report is created.  After that,
+    `compute(tsm_ah)` evaluates all pairs with array operations over the
+    snapshot's columns, and `attach` recomputes (and prints) the report
+    whenever a `SnapshotProcessor` gets a new snapshot.
+    """
+
+    def __init__(self, items, price_param="marketValue"):
+        self.price_param = price_param
+        self.names = [name for (name, _, _, _) in families]
+        all_names = [x for (_, pair, _, _) in families for x in pair]
+        # A single lookup (and cache commit) for every family
+        ids = items.get_multiple_ids(all_names)
+        self.big_ids = ids[0::2]
+        self.small_ids = ids[1::2]
+        self.multipliers = np.array([m for (_, _, m, _) in families])
+        self.reverse_ok = np.array([r for (_, _, _, r) in families])
+        self.results = None
+
+    def _columns(self, tsm_ah, ids):
+        records = [tsm_ah[item_id] for item_id in ids]
+        regions = [region_stats(r) for r in records]
+        return (
+            records,
+            # Prices keep their type, so integer copper stays integer
+            np.array([r[self.price_param] for r in records]),
+            np.array([r["soldPerDay"] for r in regions], float),
+            np.array([r["salePct"] for r in regions], float) / 100,
+            np.array([r["quantity"] for r in records], float),
+        )
 
-    for (name, pair) in primals.items():
-        print(summary(f"primal-{name}", pair_arbitrage(tsm_ah, items, pair, 10, reverse_ok=False), cutoff=2))
+    def compute(self, tsm_ah):
+        """Return {report name: `arbitrage`-style result} for all pairs."""
+        (bigs, big_p, big_sold, big_rate, big_q) = \
+            self._columns(tsm_ah, self.big_ids)
+        (smalls, small_p, small_sold, small_rate, small_q) = \
+            self._columns(tsm_ah, self.small_ids)
 
-    for (name, pair) in essences.items():
-        print(summary(f"essence-{name}", pair_arbitrage(tsm_ah, items, pair, 3), cutoff=2))
+        arb = big_p - self.multipliers * small_p
+        arb = np.where(self.reverse_ok, arb, np.maximum(arb, 0))
+        big_space = big_sold / big_rate - big_q
+        small_space = small_sold / small_rate - small_q
+        profit_big = np.maximum(big_space * big_rate * arb, 0)
+        profit_small = np.maximum(small_space * small_rate * -arb, 0)
+
+        # Index of the best status each direction reaches (len(statuses) if
+        # none); like `arbitrage`, the better one wins and "sb" wins ties
+        thresholds = np.array([profit for (profit, _) in statuses], float)
+        big_level = np.where(
+            big_space > 0,
+            (thresholds[None, :] >= profit_big[:, None]).sum(axis=1),
+            len(statuses),
+        )
+        small_level = np.where(
+            small_space > 0,
+            (thresholds[None, :] >= profit_small[:, None]).sum(axis=1),
+            len(statuses),
+        )
+
+        results = {}
+        for j in range(len(self.names)):
+            if big_level[j] < len(statuses) and big_level[j] <= small_level[j]:
+                results[self.names[j]] = {
+                    "execute": statuses[big_level[j]][1],
+                    "direction": "sb",
+                    "headroom": big_space[j].item(),
+                    "unit-profit": arb[j].item(),
+                    "saturated-profit": profit_big[j].item(),
+                    "big": bigs[j],
+                    "small": smalls[j],
+                }
+            elif small_level[j] < len(statuses):
+                results[self.names[j]] = {
+                    "execute": statuses[small_level[j]][1],
+                    "direction": "bs",
+                    "headroom": small_space[j].item(),
+                    "unit-profit": -arb[j].item(),
+                    "saturated-profit": profit_small[j].item(),
+                    "small": smalls[j],
+                }
+            else:
+                results[self.names[j]] = {
+                    "execute": (
+                        "no" if profit_small[j] <= 0 and profit_big[j] <= 0
+                        else "wtf?"
+                    ),
+                    "arb": arb[j].item(),
+                    "big_space": big_space[j].item(),
+                    "small_space": small_space[j].item(),
+                    "profit_big": profit_big[j].item(),
+                    "profit_small": profit_small[j].item(),
+                    "big": bigs[j],
+                    "small": smalls[j],
+                }
+        self.results = results
+        return results
+
+    def lines(self, cutoff=2):
+        return [summary(name, arb, cutoff=cutoff)
+                for (name, arb) in self.results.items()]
+
+    def attach(self, snapshot_processor, cutoff=2, printer=print):
+        """Recompute and print the report on every new snapshot."""
+
+        def _on_snapshot(tsm_ah):
+            self.compute(tsm_ah)
+            for line in self.lines(cutoff=cutoff):
+                printer(line)
+
+        return snapshot_processor.subscribe(_on_snapshot)
+
+
+# ElementalReport per ItemLookup, so IDs are only resolved once per process
+_reports = weakref.WeakKeyDictionary()
+
+
+def print_elemental_arbitrage_report(tsm_ah, items):
+    if items not in _reports:
+        _reports[items] = ElementalReport(items)
+    report = _reports[items]
+    report.compute(tsm_ah)
+    for line in report.lines(cutoff=2):
+        print(line)
@@ -0,0 +1,76 @@
+"""
+Call a function when a file changes.
+
+Polls the file's modification time and size, which works the same on every
+platform and needs nothing beyond the standard library.  Changes are noticed
+within one polling interval.
+"""
+import logging
+import os
+import threading
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class FileWatcher:
+
+    def __init__(self, path, callback, interval=2.0):
+        """
+        Initialize the instance.
+
+        `callback(path)` is called whenever the file at `path` changes, but
+        not for the state it is in when the watcher is created.
+        """
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self._last = self._stat()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def poll(self):
+        """Call the callback if the file changed since the last poll."""
+        current = self._stat()
+        if current == self._last:
+            return False
+        self._last = current
+        # A file being replaced may be missing for a moment; wait for it
+        if current is not None:
+            self.callback(self.path)
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                # A half-written file shouldn't stop the watching
+                logger.exception(f"Handling a change to '{self.path}' failed")
+
+    def start(self):
+        """Poll in a background thread until `stop`; returns self."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run,
+                name=f"FileWatcher({self.path})",
+                daemon=True,
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
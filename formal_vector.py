@@ -37,6 +37,10 @@ class FormalVector:
                 f"components={components.keys()}, basis={basis.keys()}"
             )
 
+    def key(self):
+        """A hashable value, equal for vectors with the same contents."""
+        return frozenset(self.triples())
+
     def is_leaf(self):
         return self.components == {self.name: 1}
 
@@ -1,10 +1,192 @@
 #!/usr/bin/env python
 
-import requests
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+import zlib
 from urllib.parse import urljoin
 
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from instrument import count
+from instrument import timed
 from tokens import AccessToken
 
+
+#
+# Rate limiting
+#
+
+
+class RateLimiter:
+    """
+    A thread-safe token bucket.
+
+    Share one instance between every `Requester` (and thread) that talks to
+    the same API so they stay under its rate limit together.  `acquire`
+    blocks until a request may be made.
+    """
+
+    def __init__(self, per_second, burst=None):
+        """Initialize the instance."""
+        self.per_second = per_second
+        self.burst = burst or per_second
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._last) * self.per_second,
+                )
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.per_second
+            count("http.rate_limited")
+            time.sleep(wait)
+
+
+#
+# Caching responses
+#
+
+
+class HttpCache:
+    """
+    An on-disk cache of GET responses, keyed by URL, query parameters and the
+    request headers named in `vary`.
+
+    Entries are kept as long as the server's `Cache-Control` allows: `max-age`
+    sets how long an entry is served without asking, `no-cache` means always
+    revalidate and `no-store` means don't keep it at all.  Responses without
+    a `Cache-Control` header are kept fresh for `default_max_age` seconds.
+    Stale entries are revalidated with `If-None-Match` / `If-Modified-Since`,
+    so an unchanged resource costs a body-less 304 rather than a download.
+
+    Bodies are stored zlib-compressed.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        vary=("Battlenet-Namespace",),
+        default_max_age=0,
+    ):
+        """Initialize the instance."""
+        self.cache_dir = cache_dir
+        self.vary = vary
+        self.default_max_age = default_max_age
+
+    def key(self, url, params, headers):
+        headers = CaseInsensitiveDict(headers)
+        material = json.dumps(
+            [
+                url,
+                sorted(dict(params or {}).items()),
+                [headers.get(h) for h in self.vary],
+            ],
+            default=str,
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def load(self, key):
+        """Return the cache entry for `key`, or None."""
+        try:
+            with open(self._path(key), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _max_age(self, headers):
+        """Seconds the response may be served from cache, None if never."""
+        cache_control = headers.get("Cache-Control")
+        if cache_control is None:
+            return self.default_max_age
+        directives = [d.strip().lower() for d in cache_control.split(",")]
+        if "no-store" in directives:
+            return None
+        if "no-cache" in directives:
+            return 0
+        for directive in directives:
+            match = re.fullmatch(r"max-age\s*=\s*(\d+)", directive)
+            if match:
+                return int(match.group(1))
+        return self.default_max_age
+
+    def store(self, key, response, body=None):
+        """
+        Save `response` under `key` (unless it forbids caching).
+
+        `body` defaults to the response content; pass it explicitly when
+        `response` is a 304 refreshing an existing entry.
+        """
+        max_age = self._max_age(response.headers)
+        if max_age is None:
+            return None
+        entry = {
+            "url": response.url,
+            "status_code": 200,
+            "headers": dict(response.headers),
+            "body": (
+                body if body is not None
+                else zlib.compress(response.content)
+            ),
+            "stored_at": time.time(),
+            "max_age": max_age,
+        }
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, path)
+        return entry
+
+    @staticmethod
+    def is_fresh(entry):
+        return time.time() < entry["stored_at"] + entry["max_age"]
+
+    @staticmethod
+    def validators(entry):
+        """Conditional request headers to revalidate `entry`."""
+        headers = CaseInsensitiveDict(entry["headers"])
+        conditional = {}
+        if "ETag" in headers:
+            conditional["If-None-Match"] = headers["ETag"]
+        if "Last-Modified" in headers:
+            conditional["If-Modified-Since"] = headers["Last-Modified"]
+        return conditional
+
+    @staticmethod
+    def to_response(entry):
+        """Rebuild a `requests.Response` from a cache entry."""
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        # The body is stored decoded; don't let anyone decode it again
+        response.headers.pop("Content-Encoding", None)
+        response._content = zlib.decompress(entry["body"])
+        response.url = entry["url"]
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers
+        )
+        response.request = requests.Request("GET", entry["url"]).prepare()
+        return response
+
 #
 # Making requests
 #
@@ -22,6 +204,9 @@ class Requester:
     3. Remembers miscellaneous extra headers (example: headers which disable
        CSRF) that are used in all the requests.
 
+    Optionally, GET responses are cached on disk with an `HttpCache`, and
+    requests are throttled by a (possibly shared) `RateLimiter`.
+
     Instead of providing separate methods for GET/POST/etc. , it provides a
     single `request` method which accepts the HTTP method name as a string.
 
@@ -39,6 +224,8 @@ class Requester:
         url,
         token: AccessToken,
         common_extra_headers=None,
+        cache: HttpCache = None,
+        rate_limiter: RateLimiter = None,
     ):
         """
         Initialize the instance.
@@ -46,11 +233,15 @@ class Requester:
         To initialize, provide `url`, the base URL for the requests; `token`,
         an `AccessToken` that provides authentication headers; and optionally
         `common_extra_headers`, a dictionary of headers to include in all
-        requests made by this instance.
+        requests made by this instance; `cache`, an `HttpCache` for GET
+        responses; and `rate_limiter`, a `RateLimiter` to wait on before each
+        request that goes to the network.
         """
         self.url = url
         self.token = token
         self.common_extra_headers = common_extra_headers or {}
+        self.cache = cache
+        self.rate_limiter = rate_limiter
 
     def _construct_url(self, path):
         return urljoin(self.url, path)
@@ -67,8 +258,11 @@ class Requester:
             self.url,
             token=token,
             common_extra_headers=self.common_extra_headers,
+            cache=self.cache,
+            rate_limiter=self.rate_limiter,
         )
 
+    @timed("http.request")
     def request(self, method, path, extra_headers=None, **kwargs):
         """
         Perform an HTTP request.
@@ -89,21 +283,55 @@ class Requester:
                 f"in requests."
             )
         extra_headers = extra_headers or {}
+        url = self._construct_url(path)
+        headers = {**self.common_extra_headers, **extra_headers}
+
+        if self.cache is not None and method.lower() == "get":
+            return self._cached_get(func, url, headers, **kwargs)
+
+        self._wait_for_rate_limit()
         # auth_headers is a property that is computed dynamically to account
         # for possible token expiry.  Therefore we can't just save the token
         # headers in a class member, we need to call `auth_headers` each time
         # we make a request!
         normal_headers = {**self.token.auth_headers}
-        return func(
-            self._construct_url(path),
-            headers={
-                **normal_headers,
-                **self.common_extra_headers,
-                **extra_headers,
-            },
+        return func(url, headers={**normal_headers, **headers}, **kwargs)
+
+    def _wait_for_rate_limit(self):
+        count("http.calls")
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def _cached_get(self, func, url, headers, **kwargs):
+        key = self.cache.key(url, kwargs.get("params"), headers)
+        entry = self.cache.load(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            count("http.cache_hits")
+            return self.cache.to_response(entry)
+
+        conditional = self.cache.validators(entry) if entry else {}
+        self._wait_for_rate_limit()
+        response = func(
+            url,
+            headers={**self.token.auth_headers, **headers, **conditional},
             **kwargs,
         )
 
+        if response.status_code == 304 and entry is not None:
+            count("http.revalidated")
+            # Keep the body we have, but take the new freshness and
+            # validators from the 304
+            response.headers = CaseInsensitiveDict(
+                {**entry["headers"], **response.headers}
+            )
+            response.url = entry["url"]
+            entry = self.cache.store(key, response, body=entry["body"]) or entry
+            return self.cache.to_response(entry)
+
+        if response.status_code == 200:
+            self.cache.store(key, response)
+        return response
+
 
 #
 # Handling responses
@@ -0,0 +1,184 @@
+"""
+Lightweight timing spans and counters.
+
+Wrap a block in `span(name)`, or a function in `@timed(name)`, to account its
+wall time under `name`; bump a counter with `count(name)`.  Everything is a
+no-op until `profiler.enable()` is called, so instrumentation can stay in the
+hot paths.
+
+Spans of the same name nest: a recursive function decorated with `timed` is
+only timed at its outermost call, so totals are never double counted.  Time
+spent in a generator is accumulated across `next()` calls, excluding the time
+the consumer spends between them.
+
+`profiler.report()` prints a breakdown; `profiler.dump_trace(path)` writes the
+spans as a Chrome trace (load it in chrome://tracing or Perfetto).
+"""
+import contextlib
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        # Spans and counters are recorded from worker threads too (realm
+        # scans, concurrent TSM fetches)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all recorded spans and counters."""
+        # name -> [calls, seconds]
+        self.totals = {}
+        self.counters = {}
+        self.events = []
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def _active(self):
+        if not hasattr(self._local, "active"):
+            self._local.active = set()
+        return self._local.active
+
+    def _record(self, name, start, elapsed):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._origin) * 1e6,
+            "dur": elapsed * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        with self._lock:
+            totals = self.totals.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Time the enclosed block under `name`."""
+        active = self._active() if self.enabled else None
+        if active is None or name in active:
+            yield
+            return
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, start, time.perf_counter() - start)
+            active.discard(name)
+
+    def count(self, name, n=1):
+        """Add `n` to the counter `name`."""
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, name=None):
+        """Decorator version of `span`; defaults to the function's name."""
+
+        def _timed(func):
+            span_name = name or func.__qualname__
+
+            if inspect.isgeneratorfunction(func):
+
+                @functools.wraps(func)
+                def _wrapped_gen(*args, **kwargs):
+                    if not self.enabled:
+                        return (yield from func(*args, **kwargs))
+                    return (yield from self._timed_gen(
+                        span_name, func(*args, **kwargs),
+                    ))
+
+                return _wrapped_gen
+
+            @functools.wraps(func)
+            def _wrapped(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+
+            return _wrapped
+
+        return _timed
+
+    def _timed_gen(self, name, gen):
+        active = self._active()
+        if name in active:
+            return (yield from gen)
+        first_start = None
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                first_start = first_start or start
+                active.add(name)
+                try:
+                    value = next(gen)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    active.discard(name)
+                    elapsed += time.perf_counter() - start
+                yield value
+        finally:
+            gen.close()
+            if first_start is not None:
+                self._record(name, first_start, elapsed)
+
+    def report(self, file=None):
+        """Print the time spent per span and the counters."""
+        file = file or sys.stdout
+        with self._lock:
+            totals = dict(self.totals)
+            counters = dict(self.counters)
+        print(f"{'span': <32} {'calls': >8} {'total ms': >12} {'mean ms': >10}",
+              file=file)
+        for (name, (calls, seconds)) in sorted(
+            totals.items(),
+            key=lambda x: -x[1][1],
+        ):
+            print(
+                f"{name: <32} {calls: >8} {seconds*1000: >12.2f} "
+                f"{seconds*1000/calls: >10.3f}",
+                file=file,
+            )
+        if counters:
+            print(f"\n{'counter': <32} {'value': >8}", file=file)
+            for (name, value) in sorted(counters.items()):
+                print(f"{name: <32} {value: >8}", file=file)
+
+    def dump_trace(self, path):
+        """Write the recorded spans and counters as a Chrome trace file."""
+        with self._lock:
+            trace = {
+                "traceEvents": list(self.events),
+                "otherData": {"counters": dict(self.counters)},
+            }
+        with open(path, "w") as f:
+            json.dump(trace, f)
+
+
+profiler = Profiler()
+
+span = profiler.span
+count = profiler.count
+timed = profiler.timed
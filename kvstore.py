@@ -1,5 +1,7 @@
 import pickle
 
+from instrument import timed
+
 class InefficientKVStore:
     
     def __init__(self, cache_path: str):
@@ -14,6 +16,7 @@ class InefficientKVStore:
         except OSError:
             return {}
     
+    @timed("kvstore.commit")
     def commit(self):
         # Insertions / Updates
         to_write = {**self.slurp(), **self._data}
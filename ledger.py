@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""
+Incremental ingestion of TSM's accounting exports.
+
+TSM writes `Accounting_{server}_{mode}.csv` for sales, purchases, expired and
+canceled auctions.  `Ledger.ingest` reads only what was added to each file
+since the last ingest and appends those rows to a columnar store (one compact
+array per column and mode).  While doing so it keeps running totals per item,
+so per-item figures -- weighted purchase price, sell-through, realized margin
+-- are looked up rather than recomputed from the full history.
+
+Each file is read from the byte offset where the last ingest stopped.  TSM
+rewrites these files rather than appending to them, so before trusting the
+offset we check that the line just before it is unchanged; if it isn't (old
+records pruned, file replaced) the whole file is scanned and rows already
+ingested are skipped by their hash.  Rows are appended to a log on disk, so
+the cost of an ingest doesn't grow with the history.
+"""
+import csv
+import hashlib
+import os
+import pickle
+from array import array
+from collections import Counter
+
+import config
+from instrument import count
+from instrument import timed
+
+
+modes = ["sales", "purchases", "expired", "canceled"]
+
+_int_columns = ["quantity", "price", "time"]
+
+
+def accounting_path(directory, server, mode):
+    return os.path.join(directory, f"Accounting_{server}_{mode}.csv")
+
+
+def _row_hash(line):
+    return hashlib.blake2b(line, digest_size=8).hexdigest()
+
+
+def _log_line(path, h, mode, item, quantity, price, time):
+    fields = [path, h, mode, item, str(quantity), str(price), str(time)]
+    return ("\t".join(fields) + "\n").encode("utf-8")
+
+
+def _parse_log_line(line):
+    """(path, hash, mode, itemString, quantity, price, time) of a log line."""
+    (path, h, mode, item, quantity, price, time) = (
+        line.decode("utf-8").rstrip("\n").split("\t")
+    )
+    return (path, h, mode, item, int(quantity), int(price), int(time))
+
+
+class ItemTotals:
+    """Running totals of one item's rows; see `Ledger.summary`."""
+
+    __slots__ = (
+        "name", "bought", "spent", "sold", "revenue", "expired", "canceled",
+    )
+
+    def __init__(self, name=None):
+        self.name = name
+        self.bought = 0
+        self.spent = 0
+        self.sold = 0
+        self.revenue = 0
+        self.expired = 0
+        self.canceled = 0
+
+    def add(self, mode, quantity, price):
+        if mode == "purchases":
+            self.bought += quantity
+            self.spent += quantity * price
+        elif mode == "sales":
+            self.sold += quantity
+            self.revenue += quantity * price
+        elif mode == "expired":
+            self.expired += quantity
+        elif mode == "canceled":
+            self.canceled += quantity
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __setstate__(self, state):
+        for (k, v) in state.items():
+            setattr(self, k, v)
+
+
+class Ledger:
+
+    def __init__(self, store_path):
+        """
+        Initialize the instance.
+
+        The store at `store_path` is created on the first `commit`.  It is
+        two files: `store_path` itself, a pickle of the file offsets, the
+        per-item totals and the hashes of each file's rows, and
+        `{store_path}.rows`, an append-only log of every row ingested.
+        """
+        self.store_path = store_path
+        self.rows_path = f"{store_path}.rows"
+        try:
+            with open(store_path, "rb") as f:
+                state = pickle.load(f)
+        except OSError:
+            state = {}
+        # path -> (offset, bytes of the line before the offset, header)
+        self.files = state.get("files", {})
+        # itemString -> ItemTotals
+        self.totals = state.get("totals", {})
+        # Bytes of the row log that belong to the committed state; anything
+        # after that was written by a commit that didn't finish
+        self._rows_size = state.get("rows_size", 0)
+        if (
+            os.path.exists(self.rows_path) and
+            os.path.getsize(self.rows_path) > self._rows_size
+        ):
+            with open(self.rows_path, "r+b") as f:
+                f.truncate(self._rows_size)
+        # Rows ingested since the last commit, as row log lines
+        self._pending = []
+        self._dirty = False
+        self._columns = None
+        # path -> Counter of the hashes of the rows ingested from it
+        self.hashes = state.get("hashes")
+        if self.hashes is None:
+            # Stores from before the hashes were kept
+            self.hashes = {}
+            for line in self._log_lines():
+                (path, h) = _parse_log_line(line)[:2]
+                self.hashes.setdefault(path, Counter())[h] += 1
+
+    def commit(self):
+        """Append the new rows to the row log and save the offsets and totals."""
+        if not self._dirty:
+            return
+        with open(self.rows_path, "ab") as f:
+            f.writelines(self._pending)
+            f.flush()
+            os.fsync(f.fileno())
+            rows_size = f.tell()
+        state = {
+            "files": self.files,
+            "totals": self.totals,
+            "hashes": self.hashes,
+            "rows_size": rows_size,
+        }
+        tmp_path = f"{self.store_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f)
+        os.replace(tmp_path, self.store_path)
+        self._rows_size = rows_size
+        self._pending = []
+        self._dirty = False
+
+    def _log_lines(self):
+        """Every row log line, committed or not."""
+        if os.path.exists(self.rows_path):
+            with open(self.rows_path, "rb") as f:
+                yield from f
+        yield from self._pending
+
+    @property
+    def columns(self):
+        """
+        {mode: {column: values}} of every row, in ingestion order.
+
+        Read from the row log on first use.
+        """
+        if self._columns is None:
+            self._columns = {
+                mode: {
+                    "itemString": [],
+                    **{c: array("q") for c in _int_columns},
+                }
+                for mode in modes
+            }
+            for line in self._log_lines():
+                self._add_to_columns(*_parse_log_line(line)[2:])
+        return self._columns
+
+    def _add_to_columns(self, mode, item, quantity, price, time):
+        columns = self._columns[mode]
+        columns["itemString"].append(item)
+        columns["quantity"].append(quantity)
+        columns["price"].append(price)
+        columns["time"].append(time)
+
+    def _start_offset(self, path, f):
+        """Where new rows start, or 0 if the file has to be rescanned."""
+        if path not in self.files:
+            return 0
+        (offset, last_line, _) = self.files[path]
+        f.seek(offset - len(last_line))
+        if f.read(len(last_line)) != last_line:
+            count("ledger.rescans")
+            return 0
+        return offset
+
+    @timed("ledger.ingest_file")
+    def ingest_file(self, path, mode):
+        """Ingest the rows of `path` not seen yet; return how many."""
+        with open(path, "rb") as f:
+            header_line = f.readline()
+            body = f.tell()
+            start = max(self._start_offset(path, f), body)
+            f.seek(start)
+            data = f.read()
+
+        # Leave a partly written last line for next time
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].splitlines(keepends=True)
+        header = next(csv.reader([header_line.decode("utf-8")]))
+        # A file we've read before that has to be rescanned holds rows we
+        # already have.  Identical rows are legitimate (two sales of a stack
+        # in the same second), so the n-th occurrence of a row is only
+        # skipped if it was ingested n times already.  New files and
+        # appended rows are taken as they are.
+        rescan = path in self.files and start == body
+        ingested = Counter(self.hashes.get(path)) if rescan else None
+        hashes = self.hashes.setdefault(path, Counter())
+        occurrences = Counter()
+
+        added = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            h = _row_hash(line)
+            if rescan:
+                occurrences[h] += 1
+                if occurrences[h] <= ingested[h]:
+                    continue
+            row = dict(zip(header, next(csv.reader([line.decode("utf-8")]))))
+            item = row["itemString"]
+            quantity = int(row["quantity"])
+            price = int(row.get("price") or 0)
+            time = int(row["time"])
+            self._pending.append(
+                _log_line(path, h, mode, item, quantity, price, time)
+            )
+            hashes[h] += 1
+            if self._columns is not None:
+                self._add_to_columns(mode, item, quantity, price, time)
+            if item not in self.totals:
+                self.totals[item] = ItemTotals(row.get("itemName"))
+            self.totals[item].add(mode, quantity, price)
+            added += 1
+
+        if lines:
+            self.files[path] = (start + end, lines[-1], header)
+            self._dirty = True
+        count("ledger.rows", added)
+        return added
+
+    def ingest(self, directory, server):
+        """Ingest every mode's file for `server`; return {mode: rows added}."""
+        added = {}
+        for mode in modes:
+            path = accounting_path(directory, server, mode)
+            if os.path.exists(path):
+                added[mode] = self.ingest_file(path, mode)
+        # Only writes anything if something was read
+        self.commit()
+        return added
+
+    def summary(self, item_string):
+        """
+        Figures for one item (e.g. "i:44958"), or None if it has no rows.
+
+        `purchase_price` is the quantity-weighted average price paid and
+        `sale_price` the average received; `sell_through` is the share of
+        auctions that sold rather than expired; `realized_margin` is what
+        the sales made after the AH cut over what those units cost at the
+        average purchase price (None if the item was never bought).
+        """
+        t = self.totals.get(item_string)
+        if t is None:
+            return None
+        purchase_price = t.spent / t.bought if t.bought else None
+        sale_price = t.revenue / t.sold if t.sold else None
+        return {
+            "itemString": item_string,
+            "itemName": t.name,
+            "bought": t.bought,
+            "sold": t.sold,
+            "expired": t.expired,
+            "canceled": t.canceled,
+            "purchase_price": purchase_price,
+            "sale_price": sale_price,
+            "sell_through": (
+                t.sold / (t.sold + t.expired) if t.sold + t.expired else None
+            ),
+            "realized_margin": (
+                t.revenue * (1 - config.ah_cut) - t.sold * purchase_price
+                if purchase_price is not None else None
+            ),
+        }
+
+    def summaries(self):
+        return [self.summary(item) for item in self.totals]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Ingest new TSM accounting rows and summarize per item",
+    )
+    parser.add_argument("server", help="Server name in the CSV file names")
+    parser.add_argument(
+        "-d", "--directory",
+        default=".",
+        help="Where the Accounting_*.csv files are",
+    )
+    parser.add_argument("-s", "--store", default="ledger.pkl")
+    parser.add_argument(
+        "-k", "--topk",
+        type=int,
+        default=20,
+        help="Show the items with the largest realized margins",
+    )
+    parsed = parser.parse_args()
+
+    from procure import format_gold
+
+    ledger = Ledger(parsed.store)
+    for (mode, n) in ledger.ingest(parsed.directory, parsed.server).items():
+        print(f"{mode}: {n} new rows")
+    rows = [
+        x for x in ledger.summaries() if x["realized_margin"] is not None
+    ]
+    rows.sort(key=lambda x: -x["realized_margin"])
+    for x in rows[:parsed.topk]:
+        sell_through = (
+            f"{100 * x['sell_through']:.0f}%"
+            if x["sell_through"] is not None else "-"
+        )
+        print(
+            f"{format_gold(x['realized_margin']): >16}  "
+            f"{x['itemName'] or x['itemString']}  "
+            f"(bought {x['bought']}, sold {x['sold']}, "
+            f"sell-through {sell_through})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Market depth: what buying N units off the auction house actually costs.
+
+A Blizzard snapshot holds every listing for every item.  `OrderBookIndex`
+sorts them once per snapshot into flat arrays with per-item prefix sums of
+quantity and cost, so the exact cost of the cheapest N units of an item is a
+binary search away.
+
+Costs are computed walking up the listings unit by unit, i.e. as if the last
+listing needed could be bought partially.  In practice auctions are bought
+whole; pass `whole_stacks=True` to include the rest of that last stack.
+"""
+import numpy as np
+
+
+class OrderBook:
+    """The listings of one item, cheapest first, with prefix sums."""
+
+    def __init__(self, prices, cum_quantity, cum_cost):
+        self.prices = prices
+        self.cum_quantity = cum_quantity
+        self.cum_cost = cum_cost
+
+    @classmethod
+    def from_auctions(cls, auctions):
+        """Build from a snapshot's list of auction dicts for one item."""
+        pairs = sorted((a["price"], a["quantity"]) for a in auctions)
+        prices = np.array([p for (p, _) in pairs], dtype=float)
+        quantities = np.array([q for (_, q) in pairs], dtype=float)
+        return cls(prices, np.cumsum(quantities), np.cumsum(prices * quantities))
+
+    @property
+    def depth(self):
+        """Total units listed."""
+        return float(self.cum_quantity[-1]) if len(self.cum_quantity) else 0.0
+
+    def cost(self, n, whole_stacks=False):
+        """Cost of the cheapest `n` units, or None if fewer are listed."""
+        if n <= 0:
+            return 0.0
+        if n > self.depth:
+            return None
+        # Listing that the n-th unit comes from
+        k = int(np.searchsorted(self.cum_quantity, n, side="left"))
+        before_q = self.cum_quantity[k - 1] if k else 0.0
+        before_cost = self.cum_cost[k - 1] if k else 0.0
+        if whole_stacks:
+            return float(self.cum_cost[k])
+        return float(before_cost + (n - before_q) * self.prices[k])
+
+    def unit_cost(self, n, whole_stacks=False):
+        """Average price per unit of the cheapest `n` units, or None."""
+        cost = self.cost(n, whole_stacks=whole_stacks)
+        if cost is None or n <= 0:
+            return None
+        return cost / n
+
+    def marginal_cost(self, n):
+        """Price of the `n`-th cheapest unit (1-based), or None."""
+        if n <= 0 or n > self.depth:
+            return None
+        k = int(np.searchsorted(self.cum_quantity, n, side="left"))
+        return float(self.prices[k])
+
+
+class OrderBookIndex:
+    """
+    Order books for every item in a Blizzard snapshot.
+
+    All listings live in shared flat arrays sorted by (item, price); each
+    item's `OrderBook` is a view on its slice.
+    """
+
+    def __init__(self, bliz_ah):
+        self.snapshot = bliz_ah
+        item_ids = []
+        prices = []
+        quantities = []
+        for (item_id, auctions) in bliz_ah.items():
+            for a in auctions:
+                item_ids.append(item_id)
+                prices.append(a["price"])
+                quantities.append(a["quantity"])
+        item_ids = np.array(item_ids, dtype=np.int64)
+        prices = np.array(prices, dtype=float)
+        quantities = np.array(quantities, dtype=float)
+
+        order = np.lexsort((prices, item_ids))
+        (item_ids, prices, quantities) = (
+            item_ids[order], prices[order], quantities[order],
+        )
+        (self._ids, starts) = np.unique(item_ids, return_index=True)
+        self._starts = starts
+        self._ends = np.append(starts[1:], len(item_ids))
+
+        # Prefix sums restart at each item: subtract the running total at the
+        # item's first listing
+        cum_quantity = np.cumsum(quantities)
+        cum_cost = np.cumsum(prices * quantities)
+        offset_q = np.repeat(
+            np.concatenate([[0.0], cum_quantity])[starts],
+            self._ends - starts,
+        )
+        offset_cost = np.repeat(
+            np.concatenate([[0.0], cum_cost])[starts],
+            self._ends - starts,
+        )
+        self._prices = prices
+        self._cum_quantity = cum_quantity - offset_q
+        self._cum_cost = cum_cost - offset_cost
+        # item_id -> OrderBook view, made on first use
+        self._books = {}
+
+    def __contains__(self, item_id):
+        j = np.searchsorted(self._ids, item_id)
+        return j < len(self._ids) and self._ids[j] == item_id
+
+    def book(self, item_id):
+        """The `OrderBook` of `item_id`, or None if it isn't listed."""
+        if item_id not in self._books:
+            j = int(np.searchsorted(self._ids, item_id))
+            if j >= len(self._ids) or self._ids[j] != item_id:
+                self._books[item_id] = None
+            else:
+                s = slice(self._starts[j], self._ends[j])
+                self._books[item_id] = OrderBook(
+                    self._prices[s],
+                    self._cum_quantity[s],
+                    self._cum_cost[s],
+                )
+        return self._books[item_id]
+
+    def cost(self, item_id, n, whole_stacks=False):
+        book = self.book(item_id)
+        return None if book is None else book.cost(n, whole_stacks=whole_stacks)
+
+    def unit_cost(self, item_id, n, whole_stacks=False):
+        book = self.book(item_id)
+        return (
+            None if book is None
+            else book.unit_cost(n, whole_stacks=whole_stacks)
+        )
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Cost-minimal production plans as a linear program.
+
+`Recipes.tree` and `procurement_options` enumerate every way to make
+something, one plan at a time; recipes with several outputs are scaled and
+cycles (eternal <-> crystallized) cut off, and the number of plans grows
+with every alternative.  Here the recipes are activities and the items
+balance constraints instead:
+
+    minimize    sum of purchase costs
+    subject to  for every item:
+                  bought + made by recipes - used by recipes >= demand
+
+with one variable per recipe (how many times it is crafted) and per way of
+buying each item.  Listings are bought cheapest first, each price level up
+to its quantity, so buying deep into the order book costs what it would.
+Conversions in both directions and by-products are just more activities.
+
+The program is solved with `scipy.optimize.linprog` (HiGHS); scipy is only
+needed here and is imported when a plan is made.  Craft counts can come out
+fractional: the LP is the relaxation of the integer problem, so round crafts
+up when following it.
+"""
+import numpy as np
+
+from crafting import Craft
+from crafting import CraftingComponents
+from crafting import Procure
+from crafting import Recipes
+from crafting import SpecificProcure
+from instrument import count
+from instrument import timed
+
+
+def _linprog():
+    try:
+        from scipy.optimize import linprog
+    except ImportError as e:
+        raise ImportError(
+            "The LP planner needs scipy: pip install scipy"
+        ) from e
+    return linprog
+
+
+def upstream_recipes(recipes: Recipes, item_ids):
+    """IDs of the recipes that `item_ids` could be made with, at any depth."""
+    result = []
+    seen_items = set(item_ids)
+    seen_recipes = set()
+    frontier = list(item_ids)
+    while frontier:
+        item_id = frontier.pop()
+        for recipe_id in recipes.out_index.get(item_id, []):
+            if recipe_id in seen_recipes:
+                continue
+            seen_recipes.add(recipe_id)
+            result.append(recipe_id)
+            (_, inputs) = recipes.storage[recipe_id]
+            for x in inputs.basis.values():
+                if x not in seen_items:
+                    seen_items.add(x)
+                    frontier.append(x)
+    return result
+
+
+class LinearPlanner:
+    """
+    Plan with the recipes of a `Recipes` and the prices of a `PriceTable`.
+
+    Items the table has no price for are treated like `procurement_options`
+    treats them: they can be had, in any quantity, for nothing, and show up
+    as plain `Procure` ops.
+    """
+
+    def __init__(self, recipes: Recipes, prices):
+        self.recipes = recipes
+        self.prices = prices
+
+    def _purchases(self, item_id):
+        """[(mode, unit price, max quantity or None)] for `item_id`."""
+        options = [
+            (mode, price, None)
+            for (mode, price) in self.prices.static.get(item_id, {}).items()
+            if price is not None
+        ]
+        book = self.prices.books.get(item_id)
+        if book is not None and book.depth:
+            (levels, starts) = np.unique(book.prices, return_index=True)
+            ends = np.append(starts[1:], len(book.prices))
+            cum = np.concatenate([[0.0], book.cum_quantity])
+            for (price, s, e) in zip(levels, starts, ends):
+                options.append(("buy now", float(price), cum[e] - cum[s]))
+        if not options:
+            options.append((None, 0.0, None))
+        return options
+
+    @timed("planner.plan")
+    def plan(self, target: CraftingComponents):
+        """
+        The cheapest way to get `target`, as `_price_method` gives plans.
+
+        Returns (cost, [(cost, op, [])]) with costs negated, like
+        `procurement_options` results, so `procure.print_results` can show
+        it.  Raises ValueError if the program can't be solved.
+        """
+        linprog = _linprog()
+        demand = {item_id: n for (_, n, item_id) in target.triples()}
+        recipe_ids = upstream_recipes(self.recipes, list(demand))
+
+        names = {}
+        for item in [target] + [
+            v for r in recipe_ids for v in self.recipes.storage[r]
+        ]:
+            for (name, _, item_id) in item.triples():
+                names[item_id] = name
+        item_ids = list(names)
+        row = {item_id: j for (j, item_id) in enumerate(item_ids)}
+
+        # Columns: recipes, then purchases
+        columns = []
+        costs = []
+        bounds = []
+        # net[i, c]: units of item i that one unit of column c yields
+        entries = []
+        for (c, recipe_id) in enumerate(recipe_ids):
+            (outputs, inputs) = self.recipes.storage[recipe_id]
+            for (_, n, item_id) in outputs.triples():
+                entries.append((row[item_id], c, n))
+            for (_, n, item_id) in inputs.triples():
+                entries.append((row[item_id], c, -n))
+            columns.append(("craft", recipe_id))
+            costs.append(0.0)
+            bounds.append((0, None))
+        for item_id in item_ids:
+            for (mode, price, limit) in self._purchases(item_id):
+                entries.append((row[item_id], len(columns), 1.0))
+                columns.append((mode, item_id))
+                costs.append(price)
+                bounds.append((0, limit))
+        net = np.zeros((len(item_ids), len(columns)))
+        for (i, c, n) in entries:
+            net[i, c] += n
+        b = np.array([demand.get(item_id, 0) for item_id in item_ids])
+        count("planner.columns", len(columns))
+
+        # net @ x >= b, as linprog wants it
+        result = linprog(
+            np.array(costs),
+            A_ub=-net,
+            b_ub=-b,
+            bounds=bounds,
+            method="highs",
+        )
+        if result.status != 0:
+            raise ValueError(f"No plan for {target}: {result.message}")
+
+        # Add up each item's purchases per mode
+        crafts = []
+        bought = {}
+        for ((kind, key), x, price) in zip(columns, result.x, costs):
+            if x <= 1e-9:
+                continue
+            if kind == "craft":
+                (outputs, _) = self.recipes.storage[key]
+                crafts.append((0, Craft(float(x) * outputs), []))
+            else:
+                (n, cost) = bought.get((kind, key), (0.0, 0.0))
+                bought[(kind, key)] = (n + x, cost + x * price)
+        operations = []
+        for ((mode, item_id), (n, cost)) in bought.items():
+            item = float(n) * CraftingComponents.named(names[item_id], item_id)
+            op = Procure(item) if mode is None else SpecificProcure(mode, item)
+            operations.append((-cost, op, []))
+        return (float(-result.fun), crafts + operations)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Find the cheapest way to make something with an LP",
+    )
+    parser.add_argument("-r", "--recipes", default="recipes.txt")
+    parser.add_argument("arg", help="What to make, e.g. '5 titanium bar'")
+    parsed = parser.parse_args()
+
+    from context import current
+    from procure import print_results
+    from procurement import PriceTable
+
+    r = current().recipes
+    with open(parsed.recipes) as f:
+        r.read_from_file(f)
+    target = r.ingredients(parsed.arg)
+    # The tree has a `Procure` for every item any recipe of it uses
+    planner = LinearPlanner(r, PriceTable.for_tree(r.tree(target)))
+    print_results([planner.plan(target)])
+
+
+if __name__ == "__main__":
+    main()
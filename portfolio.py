@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+What to craft with a fixed budget.
+
+Every recipe in a `Recipes` is a candidate.  Its reagents are bought off the
+order books and its outputs sold at TSM's market value, but only as many of
+each as the market has headroom for (see `elemental_arbitrage.headroom`).
+Recipes compete for the same reagents and the same headroom, and every unit
+bought goes deeper into the listings, so the profit of one more craft of a
+recipe depends on what else has been picked.
+
+`Portfolio` picks crafts greedily, one at a time, by profit per gold spent.
+A craft's marginal profit only ever goes down as others are picked (reagents
+get dearer, headroom runs out), so a recipe's profit ratio from an earlier
+step is an upper bound on its ratio now: the heap of recipes is "lazy" and a
+popped recipe is only repriced, not all of them.  With hundreds of recipes
+that is a few heap operations per craft picked.
+"""
+import heapq
+
+import numpy as np
+
+import config
+from conversions import RecipeMatrices
+from crafting import Recipes
+from elemental_arbitrage import headroom
+from instrument import count
+from instrument import timed
+
+
+class ReagentMarket:
+    """
+    Marginal cost of reagents as more of them are bought.
+
+    Units come off `books` (an `OrderBookIndex`) cheapest first; items in
+    `vendor_prices` can also be bought from a vendor at that price, in any
+    quantity, once the listings are dearer.
+    """
+
+    def __init__(self, books, vendor_prices=None):
+        self.books = books
+        self.vendor_prices = vendor_prices or {}
+        # item_id -> units bought so far
+        self.bought = {}
+
+    def _cost_to(self, item_id, n):
+        """Cost of the cheapest `n` units, or None if there aren't that many."""
+        if n <= 0:
+            return 0.0
+        book = self.books.book(item_id)
+        vendor = self.vendor_prices.get(item_id)
+        # Listed units worth buying instead of going to the vendor
+        if book is None:
+            listed = 0.0
+        elif vendor is None:
+            listed = book.depth
+        else:
+            cheaper = int(np.searchsorted(book.prices, vendor, side="left"))
+            listed = float(book.cum_quantity[cheaper - 1]) if cheaper else 0.0
+        if book is not None and n <= listed:
+            return book.cost(n)
+        if vendor is None:
+            return None
+        from_book = book.cost(listed) if book is not None and listed else 0.0
+        return from_book + (n - listed) * vendor
+
+    def cost(self, item_id, n):
+        """What `n` more units would cost, or None if they can't be had."""
+        q = self.bought.get(item_id, 0)
+        after = self._cost_to(item_id, q + n)
+        if after is None:
+            return None
+        return after - self._cost_to(item_id, q)
+
+    def buy(self, item_id, n):
+        self.bought[item_id] = self.bought.get(item_id, 0) + n
+
+
+class Portfolio:
+    """
+    Pick how many of each recipe to craft within a budget.
+
+    Call `solve(budget)`; the picks are in `crafts` ({recipe ID: number of
+    crafts}) and the totals in `spent` and `profit`.
+    """
+
+    def __init__(self, recipes: Recipes, tsm_ah, books, vendor_prices=None,
+                 price_param="marketValue"):
+        self.matrices = m = RecipeMatrices(recipes)
+        self.market = ReagentMarket(books, vendor_prices)
+        # Unit sale price, after the AH cut, and headroom of every item
+        self.price = {}
+        self.room = {}
+        for item_id in m.item_ids:
+            record = tsm_ah.get(item_id)
+            if record is None or not record.get(price_param):
+                continue
+            self.price[item_id] = record[price_param] * (1 - config.ah_cut)
+            try:
+                self.room[item_id] = max(0.0, headroom(record))
+            except (KeyError, ZeroDivisionError):
+                self.room[item_id] = 0.0
+        # Per recipe: [(item_id, count)] made and used
+        self._outputs = []
+        self._inputs = []
+        for r in range(len(m.recipe_ids)):
+            self._outputs.append([
+                (m.item_ids[j], m.produced[r, j])
+                for j in np.flatnonzero(m.produced[r])
+            ])
+            self._inputs.append([
+                (m.item_ids[j], m.consumed[r, j])
+                for j in np.flatnonzero(m.consumed[r])
+            ])
+        self.crafts = {}
+        self.spent = 0.0
+        self.profit = 0.0
+
+    def _marginal(self, r):
+        """(profit, cost) of one more craft of recipe row `r`, or None."""
+        revenue = sum(
+            min(n, self.room.get(item_id, 0.0)) * self.price.get(item_id, 0.0)
+            for (item_id, n) in self._outputs[r]
+        )
+        if revenue <= 0:
+            return None
+        cost = 0.0
+        for (item_id, n) in self._inputs[r]:
+            c = self.market.cost(item_id, n)
+            if c is None:
+                return None
+            cost += c
+        return (revenue - cost, cost)
+
+    def _pick(self, r, cost):
+        for (item_id, n) in self._inputs[r]:
+            self.market.buy(item_id, n)
+        for (item_id, n) in self._outputs[r]:
+            if item_id in self.room:
+                self.room[item_id] = max(0.0, self.room[item_id] - n)
+        recipe_id = self.matrices.recipe_ids[r]
+        self.crafts[recipe_id] = self.crafts.get(recipe_id, 0) + 1
+        self.spent += cost
+
+    @timed("portfolio.solve")
+    def solve(self, budget):
+        """Spend up to `budget` on crafts; return the total expected profit."""
+        heap = []
+        for r in range(len(self._outputs)):
+            marginal = self._marginal(r)
+            if marginal is not None and marginal[0] > 0:
+                heap.append((-_ratio(*marginal), r))
+        heapq.heapify(heap)
+
+        while heap:
+            (neg_ratio, r) = heapq.heappop(heap)
+            marginal = self._marginal(r)
+            count("portfolio.repriced")
+            if marginal is None or marginal[0] <= 0:
+                continue
+            ratio = _ratio(*marginal)
+            # Still at least as good as anything else: take it.  Otherwise
+            # put it back with its current ratio
+            if heap and ratio < -heap[0][0]:
+                heapq.heappush(heap, (-ratio, r))
+                continue
+            (profit, cost) = marginal
+            if self.spent + cost > budget:
+                # Doesn't fit; cheaper crafts might still
+                continue
+            self._pick(r, cost)
+            self.profit += profit
+            heapq.heappush(heap, (-ratio, r))
+        return self.profit
+
+    def results(self):
+        """[(description, crafts)] of the picks, most crafted first."""
+        m = self.matrices
+        row = {recipe_id: r for (r, recipe_id) in enumerate(m.recipe_ids)}
+        return sorted(
+            (
+                (m.describe(row[recipe_id]), n)
+                for (recipe_id, n) in self.crafts.items()
+            ),
+            key=lambda x: -x[1],
+        )
+
+
+def _ratio(profit, cost):
+    # Crafts with free reagents come first
+    return profit / cost if cost > 0 else float("inf")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Choose what to craft with a fixed budget",
+    )
+    parser.add_argument("budget", help="Gold to spend, e.g. 5000g")
+    parser.add_argument("-r", "--recipes", default="recipes.txt")
+    parser.add_argument("-p", "--price-param", default="marketValue")
+    parsed = parser.parse_args()
+
+    from context import current
+    from crafting import CraftingComponents
+    from procure import format_gold
+    from procurement import static_purchase_modes
+    from watchlist import parse_gold
+
+    budget = parse_gold(parsed.budget)
+    ctx = current()
+    with open(parsed.recipes) as f:
+        ctx.recipes.read_from_file(f)
+    portfolio = Portfolio(
+        ctx.recipes,
+        ctx.tsm_ah,
+        ctx.order_books,
+        price_param=parsed.price_param,
+    )
+    m = portfolio.matrices
+    for (item_id, name) in zip(m.item_ids, m.names):
+        vendor = static_purchase_modes(
+            CraftingComponents.named(name, item_id)
+        )["buy vendor"]
+        if vendor is not None:
+            portfolio.market.vendor_prices[item_id] = vendor
+
+    profit = portfolio.solve(budget)
+    for (description, n) in portfolio.results():
+        print(f"{n: >6} x  {description}")
+    print(
+        f"\nSpend {format_gold(portfolio.spent)} for an expected profit of "
+        f"{format_gold(profit)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,9 @@
 #!/usr/bin/env python
+import math
 
-
-from bliz_tsm_join import ItemInfoAggregator
-from blizzard import ItemLookup
-from blizzard import auction_data
-from blizzard import auction_summary
-from blizzard import collapse_languages
-from combined import dnf
-from config import blizzard_ah_id
-from config import blizzard_cache_dir
-from config import blizzard_item_cache
-from config import blizzard_item_reverse_cache
-from config import blizzard_realm_id
-from config import tsm_ah_id
-from config import tsm_cache_dir
-from config import tsm_realm_id
-from config import tsm_region_id
-from crafting import Craft
-from crafting import Procure
-from crafting import Recipes
-from crafting import SpecificProcure
-from crafting import coalesce
-from crafting import procurement_options
-from cytoolz import groupby
-from cytoolz import topk
-from functools import partial
-from kvstore import InefficientKVStore
-from pprint import pprint
-from procurement import purchase_modes
-from snapshot import SnapshotProcessor
-from tsm import auction_house_snapshot
-
-
-items = ItemLookup(
-    InefficientKVStore(blizzard_item_cache),
-    InefficientKVStore(blizzard_item_reverse_cache),
-)
-
-r = Recipes(items)
+# Only lightweight imports up here: the crafting, pricing and API modules are
+# imported in `main()` once the arguments have been parsed, so `--help` (and
+# argument errors) don't pay for them.
 
 
 def format_gold(copper_cost):
@@ -64,41 +30,114 @@ def format_op_pricing(cost, op):
         return f"{format_gold(cost)}  {op}"
 
 
+def print_results(results):
+    num = len(results)
+
+    for (j, result) in enumerate(results, start=1):
+        (total, operations) = result
+        print(f"({j}/{num}) Total gold: {format_gold(total)}")
+        for operation in operations:
+            (cost, op, alts) = operation
+            print(f"- {format_op_pricing(cost, op)}")
+            for (alt_cost, alt) in sorted(alts, key=lambda x: -x[0]):
+                print(f"      alt: {format_op_pricing(alt_cost, alt)}")
+        print("\n")
+
+
 def main():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-k", "--topk", type=int, default=5)
     parser.add_argument("-r", "--recipes", default="recipes.txt")
-    parser.add_argument("arg")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a breakdown of where the time went",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Write a Chrome trace of the run to PATH (implies --profile)",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Price plans in this many processes (0 for one per core)",
+    )
+    parser.add_argument(
+        "-f", "--file",
+        help="Read more targets from this file, one per line",
+    )
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        metavar="arg",
+        help="What to make, e.g. '5 titanium bar'",
+    )
     parsed = parser.parse_args()
 
+    targets = list(parsed.targets)
+    if parsed.file:
+        with open(parsed.file) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    targets.append(line)
+    if not targets:
+        parser.error("nothing to make: give a target or --file")
+
     k = parsed.topk
     recipes_path = parsed.recipes
-    arg = parsed.arg
 
-    with open(recipes_path) as f:
-        r.read_from_file(f)
+    from instrument import profiler
 
-    results = topk(
-        k,
-        procurement_options(
-            purchase_modes,
-            r.tree(r.ingredients(arg)),
-        ),
-        key=lambda x: x[0],
-    )
+    if parsed.profile or parsed.trace:
+        profiler.enable()
 
-    num = len(results)
+    from context import current
+    from crafting import top_procurement_options
+    from procurement import PriceTable
 
-    for (j, result) in enumerate(results, start=1):
-        (total, operations) = result
-        print(f"({j}/{num}) Total gold: {format_gold(total)}")
-        for operation in operations:
-            (cost, op, alts) = operation
-            print(f"- {format_op_pricing(cost, op)}")
-            for (alt_cost, alt) in sorted(alts, key=lambda x: -x[0]):
-                print(f"      alt: {format_op_pricing(alt_cost, alt)}")
-        print("\n")
+    r = current().recipes
+
+    with open(recipes_path) as f:
+        r.read_from_file(f)
+
+    # Targets with reagents in common share those subtrees (tree nodes are
+    # interned), and one table prices every reagent of all of them
+    trees = [r.tree(r.ingredients(arg)) for arg in targets]
+    table = PriceTable.for_trees(trees)
+    jobs = parsed.jobs or None
+    best = []
+
+    for (arg, tree) in zip(targets, trees):
+        if len(targets) > 1:
+            print(f"=== {arg} ===\n")
+        # The table's price bounds let most plans be skipped unpriced
+        results = top_procurement_options(table, tree, k, jobs=jobs)
+        if results:
+            best.append(results[0])
+        print_results(results)
+
+    if len(targets) > 1:
+        print("=== Shopping list ===\n")
+        total = 0
+        for (cost, op) in sorted(
+            table.shopping_list(best),
+            key=lambda x: -math.inf if x[0] is None else -x[0],
+        ):
+            if cost is None:
+                print(f"{'?': >16}  {op}")
+            else:
+                total += cost
+                print(f"{format_gold(cost): >16}  {op}")
+        print(f"\nTotal gold: {format_gold(total)}")
+
+    if parsed.profile or parsed.trace:
+        profiler.report()
+    if parsed.trace:
+        profiler.dump_trace(parsed.trace)
 
 
 if __name__ == "__main__":
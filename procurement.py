@@ -1,53 +1,28 @@
-from bliz_tsm_join import ItemInfoAggregator
-from blizzard import ItemLookup
-from blizzard import auction_data
-from blizzard import auction_summary
-from blizzard import collapse_languages
-from combined import dnf
-from config import blizzard_ah_id
-from config import blizzard_cache_dir
-from config import blizzard_item_cache
-from config import blizzard_item_reverse_cache
-from config import blizzard_realm_id
-from config import tsm_ah_id
-from config import tsm_cache_dir
-from config import tsm_realm_id
-from config import tsm_region_id
-from crafting import Craft
-from crafting import Procure
-from crafting import Recipes
-from crafting import SpecificProcure
-from crafting import coalesce
-from crafting import procurement_options
-from cytoolz import groupby
-from cytoolz import topk
 from functools import partial
-from kvstore import InefficientKVStore
-from pprint import pprint
-from snapshot import SnapshotProcessor
-from tsm import auction_house_snapshot
-
-
-def tsm_ah_snapper():
-    return auction_house_snapshot(tsm_region_id, tsm_realm_id, tsm_ah_id)
-
-tsm_ah_snap = SnapshotProcessor(tsm_ah_snapper, cache_dir=tsm_cache_dir)
-tsm_ah = tsm_ah_snap.get(max_age_seconds=3000)
 
-def bliz_ah_snapper():
-    return auction_data(blizzard_realm_id, blizzard_ah_id)
+from combined import Combined
+from context import current
+from crafting import Procure
+from crafting import SpecificProcure
 
-bliz_ah_snap = SnapshotProcessor(bliz_ah_snapper, cache_dir=blizzard_cache_dir)
-bliz_ah = bliz_ah_snap.get(max_age_seconds=3000)
 
-items = ItemLookup(
-    InefficientKVStore(blizzard_item_cache),
-    InefficientKVStore(blizzard_item_reverse_cache),
-)
+# These used to be built (and the snapshots fetched) when this module was
+# imported.  They now come from the application context on first access.
+_context_attributes = {
+    "tsm_ah_snap": "tsm_ah_snap",
+    "tsm_ah": "tsm_ah",
+    "bliz_ah_snap": "bliz_ah_snap",
+    "bliz_ah": "bliz_ah",
+    "items": "items",
+    "iii": "aggregator",
+    "r": "recipes",
+}
 
-iii = ItemInfoAggregator(items, bliz_ah, tsm_ah, InefficientKVStore("aggregator.pkl"))
 
-r = Recipes(items)
+def __getattr__(name):
+    if name in _context_attributes:
+        return getattr(current(), _context_attributes[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 vendor = [
@@ -79,13 +54,148 @@ def nullable_avg(a, b):
         return (a + b) / 2
 
 
-def purchase_modes(item):
-    (name, count, item_id) = item.pure()
-    p = partial(iii.get_property, item=item, default=None)
+def static_purchase_modes(item):
+    """`purchase_modes` other than "buy now", which don't depend on count."""
+    (name, _, _) = item.pure()
+    p = partial(current().aggregator.get_property, item=item, default=None)
     return {
-        "buy now": p("min") or None,
         "buy market": p("marketValue"),
         "buy vendor": p("purchase_price") if name in vendor else None,
         "long avg": nullable_avg(p(["historical"]), p(["region_historical"])),
         "roxi ramrocket": roxi.get(name),
     }
+
+
+def purchase_modes(item):
+    """
+    Unit price of `item` for each way of getting it, None where unavailable.
+
+    "buy now" walks up the current listings, so its unit price is the
+    average over the cheapest `count` units rather than the single cheapest
+    listing; it is unavailable if fewer than `count` are listed.
+    """
+    (name, count, item_id) = item.pure()
+    return {
+        "buy now": current().order_books.unit_cost(item_id, count),
+        **static_purchase_modes(item),
+    }
+
+
+def _procured_items(tree):
+    if isinstance(tree, Procure):
+        yield tree.item
+    elif isinstance(tree, Combined):
+        for x in tree:
+            yield from _procured_items(x)
+
+
+class PriceTable:
+    """
+    `purchase_modes` for the items of one tree, looked up in advance.
+
+    Holds each item's count-independent modes and its `OrderBook`, and
+    nothing that refers back to the context, so it pickles small and can
+    be handed to worker processes (`crafting.top_procurement_options`).
+    Calling it gives the same answers as `purchase_modes`, and
+    `unit_lower_bound` lets plans be pruned before they are priced.
+    """
+
+    def __init__(self, static, books):
+        # item_id -> `static_purchase_modes`
+        self.static = static
+        # item_id -> OrderBook, or None if not listed
+        self.books = books
+
+    @classmethod
+    def for_tree(cls, tree):
+        return cls.for_trees([tree])
+
+    @classmethod
+    def for_trees(cls, trees):
+        """One table for several trees, looking each item up once."""
+        items = {}
+        for tree in trees:
+            for item in _procured_items(tree):
+                items.setdefault(item.pure()[2], item)
+        order_books = current().order_books
+        return cls(
+            {
+                item_id: static_purchase_modes(item)
+                for (item_id, item) in items.items()
+            },
+            {item_id: order_books.book(item_id) for item_id in items},
+        )
+
+    def unit_lower_bound(self, item_id):
+        """
+        The lowest unit price `item_id` can have in any quantity.
+
+        That is its cheapest fixed mode or listing.  An item with no fixed
+        modes costs nothing once more are needed than are listed (there is
+        no way to price them), so its bound is 0.
+        """
+        prices = [v for v in self.static[item_id].values() if v is not None]
+        if not prices:
+            return 0
+        book = self.books[item_id]
+        if book is not None and book.depth:
+            prices.append(float(book.prices[0]))
+        return min(prices)
+
+    def __call__(self, item):
+        (_, count, item_id) = item.pure()
+        book = self.books[item_id]
+        return {
+            "buy now": None if book is None else book.unit_cost(count),
+            **self.static[item_id],
+        }
+
+    def shopping_list(self, plans):
+        """
+        What to buy for all of `plans` (`_price_method` results) at once.
+
+        Returns [(cost, op)], one `SpecificProcure` per item and way of
+        getting it, with the quantities of every plan added up.  "buy now"
+        quantities are priced against the order book as a whole, so the
+        cost reflects going deeper into the listings than any one plan
+        does; it is None if not enough are listed, as it is for items with
+        no way to buy them.
+        """
+        modes = {
+            _titled(mode): mode
+            for static in self.static.values()
+            for mode in ["buy now", *static]
+        }
+        # (op name, item_id) -> total quantity
+        totals = {}
+        for (_, operations) in plans:
+            for (_, op, _) in operations:
+                if not isinstance(op, Procure):
+                    continue
+                name = getattr(op, "name", None)
+                key = (name, op.item.pure()[2])
+                if key in totals:
+                    totals[key] += op.item
+                else:
+                    totals[key] = op.item
+
+        results = []
+        for ((name, item_id), item) in totals.items():
+            n = item.pure()[1]
+            mode = modes.get(name)
+            if mode is None:
+                (cost, op) = (None, Procure(item))
+            elif mode == "buy now":
+                book = self.books[item_id]
+                cost = None if book is None else book.cost(n)
+                op = SpecificProcure(mode, item)
+            else:
+                cost = n * self.static[item_id][mode]
+                op = SpecificProcure(mode, item)
+            results.append((cost, op))
+        return results
+
+
+def _titled(mode):
+    # How `SpecificProcure` names a mode
+    return "".join(c.title() for c in mode.split())
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Cross-realm / cross-faction arbitrage over every item at once.
+
+For every item and every target AH we look at buying at the cheapest listing
+on some *other* target and selling at this target's TSM market value.  Like
+`elemental_arbitrage.arbitrage`, the opportunity is sized by the target's
+headroom -- how many more units the market absorbs given the region's
+`soldPerDay` and `salePct` -- and the saturated profit is the headroom times
+the sale rate times the unit profit.
+
+All of it is computed as (items x targets) NumPy arrays built from a
+`realms.MarketIndex`, once per snapshot refresh.
+"""
+import numpy as np
+
+from elemental_arbitrage import statuses
+from realms import MarketIndex
+
+
+_fields = ["min", "marketValue", "tsm_quantity", "soldPerDay", "salePct"]
+
+
+def index_matrices(index: MarketIndex):
+    """
+    Return (item_ids, target_names, {field: items x targets array}).
+
+    Missing values are NaN.
+    """
+    target_names = index.target_names
+    arrays = [index.target_arrays(name) for name in target_names]
+    item_ids = np.unique(np.concatenate(
+        [np.zeros(0, dtype=np.int64)] +
+        [ids for by_kind in arrays for (ids, _) in by_kind]
+    ))
+    matrices = {
+        field: np.full((len(item_ids), len(target_names)), np.nan)
+        for field in _fields
+    }
+    for (col, by_kind) in enumerate(arrays):
+        for (ids, columns) in by_kind:
+            rows = np.searchsorted(item_ids, ids)
+            for field in _fields:
+                if field in columns:
+                    matrices[field][rows, col] = columns[field]
+    return (item_ids, target_names, matrices)
+
+
+def headroom(matrices):
+    """Units each target's market can still absorb (NaN if unknown)."""
+    sale_rate = matrices["salePct"] / 100
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return matrices["soldPerDay"] / sale_rate - matrices["tsm_quantity"]
+
+
+def scan(index: MarketIndex, same_target=False):
+    """
+    Price every (item, sell target) pair.
+
+    Returns a dict of parallel arrays, one entry per (item, sell target):
+    `item_id`, `buy_target`, `sell_target` (indices into `target_names`),
+    `buy`, `sell`, `unit_profit`, `headroom` and `saturated_profit`, plus
+    `target_names`.  With `same_target`, buying and selling on the same AH
+    is allowed too.
+    """
+    (item_ids, target_names, m) = index_matrices(index)
+    (num_items, num_targets) = m["min"].shape
+
+    buy = np.where(np.isnan(m["min"]), np.inf, m["min"])
+    if same_target:
+        buy_col = np.broadcast_to(
+            np.argmin(buy, axis=1)[:, None],
+            (num_items, num_targets),
+        )
+    elif num_targets < 2:
+        # Nowhere else to buy from
+        buy_col = np.full((num_items, num_targets), -1)
+    else:
+        # Cheapest and second cheapest target per item; when the cheapest is
+        # the sell target itself, buy from the second
+        order = np.argsort(buy, axis=1)
+        (best, second) = (order[:, 0], order[:, 1])
+        sell_col = np.arange(num_targets)[None, :]
+        buy_col = np.where(best[:, None] == sell_col, second[:, None],
+                           best[:, None])
+
+    rows = np.arange(num_items)[:, None]
+    buy_price = np.where(buy_col >= 0, buy[rows, np.maximum(buy_col, 0)],
+                         np.inf)
+    sell_price = m["marketValue"]
+    unit_profit = sell_price - buy_price
+    room = headroom(m)
+    sale_rate = m["salePct"] / 100
+    with np.errstate(invalid="ignore"):
+        saturated = np.where(
+            (room > 0) & (unit_profit > 0) & np.isfinite(unit_profit),
+            room * sale_rate * unit_profit,
+            0.0,
+        )
+    saturated = np.nan_to_num(saturated)
+
+    return {
+        "target_names": target_names,
+        "item_id": np.broadcast_to(item_ids[:, None], saturated.shape).ravel(),
+        "buy_target": np.asarray(buy_col).ravel(),
+        "sell_target": np.broadcast_to(
+            np.arange(num_targets)[None, :], saturated.shape,
+        ).ravel(),
+        "buy": buy_price.ravel(),
+        "sell": sell_price.ravel(),
+        "unit_profit": unit_profit.ravel(),
+        "headroom": room.ravel(),
+        "saturated_profit": saturated.ravel(),
+    }
+
+
+def status(saturated_profit):
+    """The `elemental_arbitrage.statuses` label for a saturated profit."""
+    return next(
+        (name for (profit, name) in statuses if saturated_profit > profit),
+        "no",
+    )
+
+
+def ranked(result, k=50):
+    """Yield the `k` most profitable opportunities as dicts, best first."""
+    profit = result["saturated_profit"]
+    k = min(k, int(np.count_nonzero(profit > 0)))
+    if k == 0:
+        return
+    top = np.argpartition(-profit, k - 1)[:k]
+    top = top[np.argsort(-profit[top])]
+    names = result["target_names"]
+    for j in top:
+        yield {
+            "execute": status(profit[j]),
+            "item_id": int(result["item_id"][j]),
+            "buy_target": names[result["buy_target"][j]],
+            "sell_target": names[result["sell_target"][j]],
+            "buy": float(result["buy"][j]),
+            "sell": float(result["sell"][j]),
+            "unit_profit": float(result["unit_profit"][j]),
+            "headroom": float(result["headroom"][j]),
+            "saturated_profit": float(profit[j]),
+        }
+
+
+class ArbitrageScanner:
+    """Re-`scan` an index only when it has changed since the last scan."""
+
+    def __init__(self, index: MarketIndex, same_target=False):
+        self.index = index
+        self.same_target = same_target
+        self._version = None
+        self._result = None
+
+    def get(self):
+        if self._version != self.index.version:
+            self._result = scan(self.index, same_target=self.same_target)
+            self._version = self.index.version
+        return self._result
+
+    def top(self, k=50):
+        return list(ranked(self.get(), k=k))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Rank arbitrage opportunities across all targets",
+    )
+    parser.add_argument("-k", "--topk", type=int, default=30)
+    parser.add_argument(
+        "--same-target",
+        action="store_true",
+        help="Also consider buying and selling on the same AH",
+    )
+    parsed = parser.parse_args()
+
+    from context import current
+    from procure import format_gold
+
+    ctx = current()
+    ctx.realm_scanner.refresh()
+    scanner = ArbitrageScanner(
+        ctx.realm_scanner.index,
+        same_target=parsed.same_target,
+    )
+    top = scanner.top(parsed.topk)
+    names = ctx.items.get_multiple_names([x["item_id"] for x in top])
+    for (name, x) in zip(names, top):
+        print(" ".join([
+            f"{x['execute'].upper(): <12}",
+            f"{name}",
+            f"{x['buy_target']} -> {x['sell_target']}",
+            f"(unit profit: {format_gold(x['unit_profit'])},",
+            f"headroom: {int(x['headroom'])},",
+            f"saturated: {format_gold(x['saturated_profit'])})",
+        ]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""
+Scan several realms / auction houses at once.
+
+Each configured `Target` has its own Blizzard and TSM snapshot streams.
+`RealmScanner.refresh` brings them all up to date concurrently (the requests
+still go through the context's shared rate limiters), and a `MarketIndex`
+subscribed to the streams keeps a per-item view across every target for
+cross-realm queries.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import NamedTuple
+
+import numpy as np
+
+import config
+from blizzard import auction_data
+from snapshot import SnapshotProcessor
+from tsm import auction_house_snapshot
+
+
+class Target(NamedTuple):
+    name: str
+    tsm_region_id: int
+    tsm_realm_id: int
+    tsm_ah_id: int
+    blizzard_realm_id: int
+    blizzard_ah_id: int
+
+
+def configured_targets():
+    return [Target(**t) for t in config.targets]
+
+
+def target_streams(target: Target, region_snap: SnapshotProcessor = None):
+    """
+    Return (Blizzard stream, TSM stream) for a non-home `target`.
+
+    Their snapshots go to "<cache dir>-<target name>".  TSM snapshots are
+    joined against `region_snap`, the target region's stream, when given;
+    share it between targets in the same region.
+    """
+    suffix = f"-{target.name}"
+    bliz_snap = SnapshotProcessor(
+        partial(auction_data, target.blizzard_realm_id, target.blizzard_ah_id),
+        cache_dir=f"{config.blizzard_cache_dir}{suffix}",
+    )
+
+    def tsm_snapper():
+        region = region_snap and region_snap.get(
+            max_age_seconds=config.tsm_region_max_age_seconds,
+        )
+        return auction_house_snapshot(
+            target.tsm_region_id,
+            target.tsm_realm_id,
+            target.tsm_ah_id,
+            region=region,
+        )
+
+    tsm_snap = SnapshotProcessor(
+        tsm_snapper,
+        cache_dir=f"{config.tsm_cache_dir}{suffix}",
+    )
+    return (bliz_snap, tsm_snap)
+
+
+class MarketIndex:
+    """
+    Per-item summaries of every target, kept in memory.
+
+    For each target this holds the cheapest listing and quantity listed per
+    item, and TSM's market value, so questions like "where is this cheapest"
+    are answered without touching the snapshots.  A new snapshot replaces its
+    target's entries wholesale.
+    """
+
+    def __init__(self):
+        # target name -> item_id -> summary
+        self._auctions = {}
+        self._tsm = {}
+        # (target name, "auctions" or "tsm") -> (item IDs, {field: values}),
+        # made on first use after each update
+        self._arrays = {}
+        # Bumped on every update, so derived views know when to recompute
+        self.version = 0
+
+    def update_auctions(self, target_name, bliz_ah):
+        """Take the listings of a new Blizzard snapshot for `target_name`."""
+        self._auctions[target_name] = {
+            item_id: {
+                "min": min(a["price"] for a in auctions),
+                "quantity": sum(a["quantity"] for a in auctions),
+            }
+            for (item_id, auctions) in bliz_ah.items()
+            if auctions
+        }
+        self._arrays.pop((target_name, "auctions"), None)
+        self.version += 1
+
+    def update_tsm(self, target_name, tsm_ah):
+        """Take the prices of a new TSM snapshot for `target_name`."""
+        self._tsm[target_name] = {
+            item_id: {
+                "marketValue": record.get("marketValue"),
+                # Quantity TSM sees on this AH, and the region's sale rates
+                "tsm_quantity": record.get("quantity"),
+                "soldPerDay": record.get("soldPerDay"),
+                "salePct": record.get("salePct"),
+            }
+            for (item_id, record) in tsm_ah.items()
+        }
+        self._arrays.pop((target_name, "tsm"), None)
+        self.version += 1
+
+    @property
+    def target_names(self):
+        return sorted(set(self._auctions) | set(self._tsm))
+
+    def item_ids(self):
+        """Every item any target has a listing or TSM price for."""
+        return set().union(
+            *(by_item.keys() for by_item in self._auctions.values()),
+            *(by_item.keys() for by_item in self._tsm.values()),
+        )
+
+    def target_summaries(self, target_name):
+        """Yield (item_id, summary) for every item `target_name` has."""
+        auctions = self._auctions.get(target_name, {})
+        tsm = self._tsm.get(target_name, {})
+        for item_id in auctions.keys() | tsm.keys():
+            yield (item_id, {**auctions.get(item_id, {}), **tsm.get(item_id, {})})
+
+    def target_arrays(self, target_name):
+        """
+        The summaries of `target_name` as arrays.
+
+        Returns [(item IDs, {field: values})], one for its listings and one
+        for its TSM prices, with NaN for missing values.
+        """
+        result = []
+        for (kind, by_kind) in [
+            ("auctions", self._auctions),
+            ("tsm", self._tsm),
+        ]:
+            key = (target_name, kind)
+            if key not in self._arrays:
+                by_item = by_kind.get(target_name, {})
+                fields = next(iter(by_item.values()), {}).keys()
+                self._arrays[key] = (
+                    np.fromiter(
+                        by_item.keys(),
+                        dtype=np.int64,
+                        count=len(by_item),
+                    ),
+                    {
+                        field: np.fromiter(
+                            (
+                                np.nan if s[field] is None else s[field]
+                                for s in by_item.values()
+                            ),
+                            dtype=float,
+                            count=len(by_item),
+                        )
+                        for field in fields
+                    },
+                )
+            result.append(self._arrays[key])
+        return result
+
+    def summaries(self, item_id):
+        """{target name: summary} for `item_id`, for targets that have it."""
+        result = {}
+        for name in self.target_names:
+            summary = {
+                **self._auctions.get(name, {}).get(item_id, {}),
+                **self._tsm.get(name, {}).get(item_id, {}),
+            }
+            if summary:
+                result[name] = summary
+        return result
+
+    def cheapest(self, item_id):
+        """(target name, min price) of the cheapest listing, or None."""
+        prices = [
+            (by_item[item_id]["min"], name)
+            for (name, by_item) in self._auctions.items()
+            if item_id in by_item
+        ]
+        if not prices:
+            return None
+        (price, name) = min(prices)
+        return (name, price)
+
+    def cheapest_many(self, item_ids):
+        return {item_id: self.cheapest(item_id) for item_id in item_ids}
+
+
+class RealmScanner:
+
+    def __init__(self, targets, streams, index: MarketIndex = None):
+        """
+        Initialize the instance.
+
+        `streams` maps each target's name to its (Blizzard, TSM) snapshot
+        processors.  The `index` is subscribed to all of them.
+        """
+        self.targets = targets
+        self.streams = streams
+        self.index = index or MarketIndex()
+        for target in targets:
+            (bliz_snap, tsm_snap) = streams[target.name]
+            bliz_snap.subscribe(partial(self.index.update_auctions, target.name))
+            tsm_snap.subscribe(partial(self.index.update_tsm, target.name))
+
+    def refresh(self, max_age_seconds=3000, max_workers=None):
+        """
+        Bring every stream up to date, concurrently.
+
+        Returns {target name: (Blizzard snapshot, TSM snapshot)}.
+        """
+        jobs = [
+            (target.name, kind, snap)
+            for target in self.targets
+            for (kind, snap) in zip(["bliz", "tsm"], self.streams[target.name])
+        ]
+        with ThreadPoolExecutor(max_workers=max_workers or len(jobs)) as pool:
+            futures = [
+                (name, kind, pool.submit(snap.get, max_age_seconds=max_age_seconds))
+                for (name, kind, snap) in jobs
+            ]
+            results = {}
+            for (name, kind, future) in futures:
+                results.setdefault(name, {})[kind] = future.result()
+        return {
+            name: (data["bliz"], data["tsm"])
+            for (name, data) in results.items()
+        }
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Find the cheapest listing of items across all targets",
+    )
+    parser.add_argument("names", nargs="+", metavar="ITEM")
+    parsed = parser.parse_args()
+
+    from context import current
+    from procure import format_gold
+
+    ctx = current()
+    scanner = ctx.realm_scanner
+    scanner.refresh()
+    for (name, item_id) in zip(
+        parsed.names,
+        ctx.items.get_multiple_ids(parsed.names),
+    ):
+        cheapest = scanner.index.cheapest(item_id)
+        if cheapest is None:
+            print(f"{name}: not listed anywhere")
+        else:
+            (target_name, price) = cheapest
+            print(f"{name}: {format_gold(price)} on {target_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Where-used cost propagation over the recipe graph.
+
+`CostPropagator` keeps the cheapest way to get one unit of every item in a
+`Recipes` -- buy it, or craft it from the cheapest reagents -- and what that
+costs.  When buy prices change, only the items downstream of the changed ones
+(found through `Recipes.in_index`) are reset and worked out again; everything
+else keeps its cost, since it doesn't depend on anything that changed.
+
+Items are recomputed in topological order, reagents before what is made
+from them, so each recipe is priced from final reagent costs.  Conversion
+cycles (eternal <-> crystallized) are strongly connected components of the
+graph; their items are settled together by relaxing until nothing improves.
+A cycle that never stops improving is an arbitrage loop: its items are
+costed at their buy price and listed in `arbitrage`.
+
+Like `Recipes.tree`, a recipe making several items is charged in full to
+each of them.
+"""
+import math
+
+from crafting import Recipes
+from instrument import count
+from instrument import timed
+
+
+class CostPropagator:
+
+    def __init__(self, recipes: Recipes, buy_prices=None):
+        """
+        Initialize the instance.
+
+        `buy_prices` maps item IDs to their unit buy price (None or missing
+        if they can't be bought).  The propagator follows changes to the
+        recipes through `Recipes.subscribe`.
+        """
+        self.recipes = recipes
+        # item_id -> unit buy price
+        self.buy = {}
+        # item_id -> cheapest unit cost; items that can't be had are absent
+        self.cost = {}
+        # item_id -> recipe ID of the cheapest way to craft it, or None if
+        # buying is cheapest
+        self.how = {}
+        # Items of conversion cycles that come out cheaper every time round
+        # (arbitrage loops); they are costed at their buy price
+        self.arbitrage = set()
+        self._compile()
+        self.buy = {
+            item_id: price
+            for (item_id, price) in (buy_prices or {}).items()
+            if price is not None
+        }
+        self._propagate(self.item_ids)
+        recipes.subscribe(self._recipes_changed)
+
+    def _compile(self):
+        # recipe ID -> [(item_id, count)]
+        self._inputs = {}
+        self._outputs = {}
+        for (recipe_id, (outputs, inputs)) in self.recipes.storage.items():
+            self._inputs[recipe_id] = [
+                (item_id, n) for (_, n, item_id) in inputs.triples()
+            ]
+            self._outputs[recipe_id] = [
+                (item_id, n) for (_, n, item_id) in outputs.triples()
+            ]
+        self.item_ids = (
+            set(self.recipes.in_index) | set(self.recipes.out_index)
+        )
+
+    def downstream(self, item_ids):
+        """`item_ids` and every item made from them, directly or not."""
+        result = set(item_ids)
+        frontier = list(result)
+        while frontier:
+            item_id = frontier.pop()
+            for recipe_id in self.recipes.in_index.get(item_id, []):
+                for (output_id, _) in self._outputs[recipe_id]:
+                    if output_id not in result:
+                        result.add(output_id)
+                        frontier.append(output_id)
+        return result
+
+    def craft_cost(self, recipe_id):
+        """Cost of crafting `recipe_id` once from the cheapest reagents."""
+        total = 0
+        for (item_id, n) in self._inputs[recipe_id]:
+            if item_id not in self.cost:
+                return None
+            total += n * self.cost[item_id]
+        return total
+
+    def _components(self, affected):
+        """
+        Strongly connected components of the recipe graph within `affected`,
+        reagents before what they make.
+        """
+        def _successors(item_id):
+            for recipe_id in self.recipes.in_index.get(item_id, []):
+                for (output_id, _) in self._outputs[recipe_id]:
+                    if output_id in affected:
+                        yield output_id
+
+        # Tarjan's algorithm, without recursion
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in affected:
+            if root in index:
+                continue
+            work = [(root, _successors(root))]
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                (node, successors) = work[-1]
+                for succ in successors:
+                    if succ not in index:
+                        index[succ] = low[succ] = len(index)
+                        stack.append(succ)
+                        on_stack.add(succ)
+                        work.append((succ, _successors(succ)))
+                        break
+                    elif succ in on_stack:
+                        low[node] = min(low[node], index[succ])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            item_id = stack.pop()
+                            on_stack.discard(item_id)
+                            component.append(item_id)
+                            if item_id == node:
+                                break
+                        components.append(component)
+        # Tarjan finds components consumers first
+        components.reverse()
+        return components
+
+    @timed("repricing.propagate")
+    def _propagate(self, affected):
+        """Work out the costs of `affected`, a downstream-closed item set."""
+        count("repricing.items", len(affected))
+        for item_id in affected:
+            self.cost.pop(item_id, None)
+            self.how.pop(item_id, None)
+        self.arbitrage -= affected
+
+        for component in self._components(affected):
+            for item_id in component:
+                if self.buy.get(item_id) is not None:
+                    self.cost[item_id] = self.buy[item_id]
+                    self.how[item_id] = None
+            recipe_ids = list(dict.fromkeys(
+                recipe_id
+                for item_id in component
+                for recipe_id in self.recipes.out_index.get(item_id, [])
+            ))
+            members = set(component)
+            # Everything feeding the component is settled by now; within it
+            # (conversion cycles) relax until nothing improves.  A cycle
+            # that keeps improving is an arbitrage loop, with no cheapest
+            # cost; after as many rounds as it has items its items go back
+            # to being bought, or can't be had.
+            for _ in range(len(component) + 1):
+                improved = False
+                for recipe_id in recipe_ids:
+                    total = self.craft_cost(recipe_id)
+                    if total is None:
+                        continue
+                    for (item_id, n) in self._outputs[recipe_id]:
+                        if (
+                            item_id in members and
+                            total / n < self.cost.get(item_id, math.inf)
+                        ):
+                            self.cost[item_id] = total / n
+                            self.how[item_id] = recipe_id
+                            improved = True
+                if not improved:
+                    break
+            else:
+                count("repricing.arbitrage_cycles")
+                for item_id in component:
+                    self.cost.pop(item_id, None)
+                    self.how.pop(item_id, None)
+                    if self.buy.get(item_id) is not None:
+                        self.cost[item_id] = self.buy[item_id]
+                        self.how[item_id] = None
+                self.arbitrage.update(component)
+
+    def update_prices(self, prices):
+        """
+        Take new buy prices and update the costs that depend on them.
+
+        `prices` maps item IDs to their unit buy price, None if they can no
+        longer be bought; items not in it keep their price.  Returns the IDs
+        of the items whose cost changed.
+        """
+        changed = set()
+        for (item_id, price) in prices.items():
+            if self.buy.get(item_id) != price:
+                changed.add(item_id)
+                if price is None:
+                    self.buy.pop(item_id, None)
+                else:
+                    self.buy[item_id] = price
+        return self._update(changed)
+
+    def _update(self, changed):
+        if not changed:
+            return set()
+        affected = self.downstream(changed)
+        before = {item_id: self.cost.get(item_id) for item_id in affected}
+        self._propagate(affected)
+        return {
+            item_id for item_id in affected
+            if self.cost.get(item_id) != before[item_id]
+        }
+
+    def _recipes_changed(self, item_ids):
+        self._compile()
+        self._update(set(item_ids))
+
+    def attach(self, snapshot_processor, price_param="marketValue",
+               callback=None):
+        """
+        Update from every new TSM snapshot of `snapshot_processor`.
+
+        Buy prices are the snapshot's `price_param`.  `callback`, if given,
+        is called with the IDs of the items whose cost changed.
+        """
+
+        def _on_snapshot(tsm_ah):
+            changed = self.update_prices({
+                item_id: (
+                    tsm_ah[item_id].get(price_param) if item_id in tsm_ah
+                    else None
+                )
+                for item_id in self.item_ids
+            })
+            if callback is not None:
+                callback(changed)
+
+        return snapshot_processor.subscribe(_on_snapshot)
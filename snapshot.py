@@ -1,25 +1,182 @@
+import bisect
 import datetime
 import glob
 import logging
 import os
 import pickle
+import threading
 from requests import HTTPError
 
+from instrument import count
+from instrument import span
+from instrument import timed
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
-def _newest_snapshot_and_time(directory, snap_format):
-    try:
-        newest_snapshot = max(glob.glob(os.path.join(directory, "*")))
-        newest_time = datetime.datetime.strptime(
-            newest_snapshot,
-            os.path.join(directory, snap_format),
-        )
-        return (newest_snapshot, newest_time)
-    except ValueError:
-        return (None, None)
+def archived_snapshots(directory, snap_format):
+    """[(time, path)] of every snapshot in `directory`, oldest first."""
+    results = []
+    for path in glob.glob(os.path.join(directory, "*")):
+        try:
+            time = datetime.datetime.strptime(
+                path,
+                os.path.join(directory, snap_format),
+            )
+        except ValueError:
+            continue
+        results.append((time, path))
+    results.sort()
+    return results
+
+
+class SnapshotManifest:
+    """
+    An index of the snapshots in a cache directory.
+
+    Each snapshot written is recorded as a line of `.manifest` in the
+    directory: its time, file name, size in bytes and number of items.  The
+    file is only ever appended to, and read from where it was last read, so
+    finding the newest snapshot (or the one at a given time, or those in a
+    range) costs a `stat` rather than a listing and parse of the directory.
+
+    A directory without a manifest, i.e. one written before there were
+    manifests, is indexed from a listing once (with no item counts).
+    """
+
+    def __init__(self, directory, snap_format):
+        self.directory = directory
+        self.snap_format = snap_format
+        self.path = os.path.join(directory, ".manifest")
+        # (time, path, size, item count) sorted by time
+        self.entries = []
+        self._times = []
+        # (device, inode) of the manifest file read, and how many bytes
+        self._file_id = None
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _rebuild(self):
+        count("snapshot.manifest_rebuilds")
+        lines = []
+        for (time, path) in archived_snapshots(
+            self.directory,
+            self.snap_format,
+        ):
+            lines.append(_manifest_line(
+                time,
+                os.path.basename(path),
+                os.path.getsize(path),
+                None,
+            ))
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.path)
+
+    def _refresh(self):
+        """Read what was appended, by us or other processes, since last time."""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            if not os.path.isdir(self.directory):
+                return
+            self._rebuild()
+            f = open(self.path, "rb")
+        with f:
+            # Stat what we opened: the manifest may be replaced at any time
+            st = os.fstat(f.fileno())
+            file_id = (st.st_dev, st.st_ino)
+            if file_id != self._file_id or st.st_size < self._offset:
+                # A different file (rebuilt, maybe by another process), or
+                # truncated: our offset means nothing in it
+                (self.entries, self._times, self._offset) = ([], [], 0)
+                self._file_id = file_id
+            if st.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read()
+        # Leave a partly written last line for next time
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf-8").splitlines():
+            (time, name, size_, items) = line.split("\t")
+            entry = (
+                datetime.datetime.fromisoformat(time),
+                os.path.join(self.directory, name),
+                int(size_),
+                int(items) if items else None,
+            )
+            if self._times and entry[0] < self._times[-1]:
+                j = bisect.bisect(self._times, entry[0])
+                self.entries.insert(j, entry)
+                self._times.insert(j, entry[0])
+            else:
+                self.entries.append(entry)
+                self._times.append(entry[0])
+        self._offset += end
+
+    def add(self, time, path, size, items=None):
+        """Record a snapshot just written to `path`."""
+        with self._lock:
+            self._refresh()
+            if self.entries and self.entries[-1][1] == path:
+                # Already there: overwritten within the same second, or the
+                # manifest was just built from a listing that included it
+                return
+            with open(self.path, "a") as f:
+                f.write(
+                    _manifest_line(time, os.path.basename(path), size, items)
+                )
+            self._refresh()
+
+    def newest(self):
+        """(path, time) of the newest snapshot, or (None, None)."""
+        with self._lock:
+            self._refresh()
+            if self.entries and not os.path.exists(self.entries[-1][1]):
+                # Snapshots were removed behind our back
+                self._rebuild()
+                self._refresh()
+            if not self.entries:
+                return (None, None)
+            (time, path, _, _) = self.entries[-1]
+            return (path, time)
+
+    def at(self, time):
+        """(path, time) of the last snapshot taken at or before `time`."""
+        with self._lock:
+            self._refresh()
+            j = bisect.bisect_right(self._times, time)
+            # Skip snapshots deleted since they were recorded
+            for (time, path, _, _) in reversed(self.entries[:j]):
+                if os.path.exists(path):
+                    return (path, time)
+            return (None, None)
+
+    def range(self, start=None, end=None):
+        """[(time, path)] of the snapshots from `start` up to `end`."""
+        with self._lock:
+            self._refresh()
+            i = 0 if start is None else bisect.bisect_left(self._times, start)
+            j = (
+                len(self._times) if end is None
+                else bisect.bisect_left(self._times, end)
+            )
+            return [
+                (time, path) for (time, path, _, _) in self.entries[i:j]
+                if os.path.exists(path)
+            ]
+
+
+def _manifest_line(time, name, size, items):
+    return "\t".join([
+        time.isoformat(),
+        name,
+        str(size),
+        "" if items is None else str(items),
+    ]) + "\n"
 
 
 class SnapshotProcessor:
@@ -30,54 +187,112 @@ class SnapshotProcessor:
         self.snap_format = "-".join([snap_prefix, "%Y-%m-%dT%H-%M-%S"])
         self._data = None
         self._cache_forced = None
+        self._subscribers = []
+        self.manifest = SnapshotManifest(cache_dir, self.snap_format)
+        # Several threads may want the same stream (e.g. AH streams sharing a
+        # region stream); only one of them fetches
+        self._lock = threading.RLock()
+
+    def subscribe(self, callback):
+        """
+        Call `callback(data)` whenever `get` loads or fetches a new snapshot.
+
+        If a snapshot is already in memory, `callback` is called with it right
+        away.  Returns `callback`, so this can be used as a decorator.
+        """
+        self._subscribers.append(callback)
+        if self._data is not None:
+            callback(self._data)
+        return callback
+
+    @property
+    def _fetch_name(self):
+        # partials have no __name__
+        return getattr(self.fetch_func, "__name__", repr(self.fetch_func))
+
+    def _fetch(self):
+        count("snapshot.fetches")
+        with span("snapshot.fetch"):
+            return self.fetch_func()
+
+    def load(self, snap_path):
+        count("snapshot.disk_loads")
+        with span("snapshot.unpickle"):
+            with open(snap_path, "rb") as f:
+                return pickle.load(f)
 
+    def archive(self, start=None, end=None):
+        """
+        [(time, path)] of the snapshots saved so far, oldest first.
+
+        Only those taken at or after `start` and before `end` if given.
+        """
+        return self.manifest.range(start, end)
+
+    def _save(self, now):
+        snap_filename = now.strftime(self.snap_format)
+        snap_path = os.path.join(self.cache_dir, snap_filename)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(snap_path, "wb") as f:
+            pickle.dump(self._data, f)
+            size = f.tell()
+        self.manifest.add(
+            now.replace(microsecond=0),
+            snap_path,
+            size,
+            len(self._data) if hasattr(self._data, "__len__") else None,
+        )
+
+    @timed("snapshot.get")
     def get(self, max_age_seconds=3000, fallback_to_cache=True):
-        (snap_path, last_update) = \
-            _newest_snapshot_and_time(self.cache_dir, self.snap_format)
+        with self._lock:
+            return self._get(max_age_seconds, fallback_to_cache)
+
+    def _get(self, max_age_seconds, fallback_to_cache):
+        (snap_path, last_update) = self.manifest.newest()
         now = datetime.datetime.now()
+        previous = self._data
 
         # First get ever
         if snap_path is None:
-            self._data = self.fetch_func()
-            snap_filename = now.strftime(self.snap_format)
-            os.makedirs(self.cache_dir, exist_ok=True)
-            with open(os.path.join(self.cache_dir, snap_filename), "wb") as f:
-                pickle.dump(self._data, f)
+            self._data = self._fetch()
+            self._save(now)
 
         # We are forcing use of the cache for 5 minutes due to a fetch issue
         elif (
             self._cache_forced and
             now < self._cache_forced + datetime.timedelta(seconds=300)
         ):
-            snap_filename = now.strftime(self.snap_format)
-            with open(os.path.join(self.cache_dir, snap_filename), "wb") as f:
-                pickle.dump(self._data, f)
+            self._save(now)
 
         # Last snap too old
         # (same as first get ever, but fallback to cache is available)
         elif now > last_update + datetime.timedelta(seconds=max_age_seconds):
             self._cache_forced = None
             try:
-                self._data = self.fetch_func()
+                self._data = self._fetch()
             except Exception as err:
                 logger.warning(
-                    f"Could not fetch data with '{self.fetch_func.__name__}', "
+                    f"Could not fetch data with '{self._fetch_name}', "
                     f"falling back to cached "
                     f"'{snap_path}' from '{last_update}' as requested.  "
                     f"Error info (next line)\n{err}"
                 )
-                with open(snap_path, "rb") as f:
-                    self._data = pickle.load(f)
+                self._data = self.load(snap_path)
                 self._cache_forced = now
             else:
-                snap_filename = now.strftime(self.snap_format)
-                with open(os.path.join(self.cache_dir, snap_filename), "wb") as f:
-                    pickle.dump(self._data, f)
+                self._save(now)
 
         # Last snap sufficient, but haven't loaded it into memory yet
         elif self._data is None:
-            with open(snap_path, "rb") as f:
-                self._data = pickle.load(f)
+            self._data = self.load(snap_path)
+
+        else:
+            count("snapshot.memory_hits")
+
+        if self._data is not previous:
+            for callback in self._subscribers:
+                callback(self._data)
 
         # Return snap data from in-memory cache
         return self._data
@@ -0,0 +1,28 @@
+from orderbook import OrderBookIndex
+from portfolio import ReagentMarket
+
+
+def test_vendor_only_reagent():
+    books = OrderBookIndex({1: [{"price": 100, "quantity": 5}]})
+    market = ReagentMarket(books, vendor_prices={2: 50})
+    assert market.cost(2, 3) == 150
+    market.buy(2, 3)
+    assert market.cost(2, 2) == 100
+
+
+def test_listings_then_vendor():
+    books = OrderBookIndex({
+        1: [{"price": 5, "quantity": 2}, {"price": 10, "quantity": 3}],
+    })
+    market = ReagentMarket(books, vendor_prices={1: 8})
+    # Listings below the vendor price first, then the vendor
+    assert market.cost(1, 3) == 2 * 5 + 8
+    assert ReagentMarket(books).cost(1, 5) == 2 * 5 + 3 * 10
+
+
+def test_unavailable_reagent():
+    books = OrderBookIndex({1: [{"price": 100, "quantity": 5}]})
+    market = ReagentMarket(books)
+    assert market.cost(1, 6) is None
+    assert market.cost(2, 1) is None
+    assert market.cost(2, 0) == 0.0
@@ -2,12 +2,26 @@
 This module contains helper methods for authenticating with various
 aspects of a Domino deployment.
 """
+import contextlib
+import hashlib
+import json
+import os
+import threading
 import time
 from urllib.parse import urlparse, urljoin, parse_qs
 
 import bs4
 import requests
 
+from instrument import timed
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no `fcntl`, but `msvcrt` has an equivalent byte-range lock
+    fcntl = None
+    import msvcrt
+
 
 class AccessToken:
     """Base class for an access token."""
@@ -39,21 +53,150 @@ class ConstantHeader(AccessToken):
         return {self.header: self.value}
 
 
-class TSMToken(AccessToken):
+class TokenCache:
+    """
+    Share OAuth tokens between processes through a file on disk.
+
+    The file is only readable and writable by its owner.  Refreshes are
+    serialized with a lock file next to it, so when several processes find
+    the token expired at the same time only the first one goes back to the
+    auth server; the others pick up its result.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_credentials(cls, cache_dir, kind, credentials):
+        """
+        Cache for tokens of `kind` obtained with the given `credentials`.
+
+        The credentials are hashed into the filename so a changed key doesn't
+        reuse the token issued for the old one.
+        """
+        digest = hashlib.sha256(credentials.encode("utf-8")).hexdigest()[:16]
+        return cls(os.path.join(cache_dir, f"{kind}-{digest}.json"))
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold an exclusive lock on the cache for the duration."""
+        os.makedirs(os.path.dirname(self.path) or ".", mode=0o700, exist_ok=True)
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            yield self
+        finally:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            os.close(fd)
+
+    def load(self):
+        """Return the cached token state, or None if there is none."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, state):
+        """Atomically replace the cached token state."""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+
+class OAuthToken(AccessToken):
+    """
+    Base class for tokens obtained from an OAuth server.
+
+    Subclasses implement `_update`, which (re)populates `tokens` and
+    `expire_time`.  If a `TokenCache` is given, tokens are shared with other
+    processes through it until they expire.
+    """
+
+    # Token state that is saved to / restored from the cache
+    _cached_attributes = ["tokens", "expire_time"]
+
+    def __init__(self, leeway=60, cache: TokenCache = None):
+        """Initialize the instance."""
+        # Token initialization is lazy: no guarantees you have a valid token
+        # until you try calling `get()`
+        self.tokens = None
+        self.expire_time = None
+        self.leeway = leeway
+        self.cache = cache
+        # Threads sharing this token refresh it one at a time
+        self._lock = threading.Lock()
+
+    def _update(self):
+        raise NotImplementedError("Override me")
+
+    def _needs_update(self):
+        return self.tokens is None or time.time() > self.expire_time
+
+    def _restore_from_cache(self):
+        state = self.cache.load()
+        if state is not None:
+            for attr in self._cached_attributes:
+                setattr(self, attr, state.get(attr))
+
+    def _save_to_cache(self):
+        self.cache.store(
+            {attr: getattr(self, attr) for attr in self._cached_attributes}
+        )
+
+    @timed("token.refresh")
+    def _refresh_tokens(self):
+        with self._lock:
+            # Another thread may have refreshed while we waited
+            if not self._needs_update():
+                return
+            if self.cache is None:
+                self._update()
+            else:
+                self._refresh_through_cache()
+
+    def _refresh_through_cache(self):
+        with self.cache.lock():
+            # Another process may have refreshed while we waited
+            self._restore_from_cache()
+            if self._needs_update():
+                self._update()
+                self._save_to_cache()
+
+    def get(self):
+        """Retrieve the token, refreshing if necessary."""
+        if self._needs_update():
+            self._refresh_tokens()
+        return self.tokens["access_token"]
+
+    @property
+    def auth_headers(self):
+        return {"Authorization": f"Bearer {self.get()}"}
+
+
+class TSMToken(OAuthToken):
+
+    _cached_attributes = ["tokens", "expire_time", "refresh_expire_time"]
 
     def __init__(
         self,
         token,
         leeway=60,
+        cache: TokenCache = None,
     ):
         """Initialize the instance."""
+        super().__init__(leeway=leeway, cache=cache)
         self.token = token
-        # Token initialization is lazy: no guarantees you have a valid token
-        # until you try calling `get()`
-        self.tokens = None
         self.refresh_expire_time = None
-        self.expire_time = None
-        self.leeway = leeway
 
     def _request_tokens_with_grant(self, grant_data):
         """Get the access token given the `grant_data`."""
@@ -99,38 +242,32 @@ class TSMToken(AccessToken):
             },
         )
 
-    def get(self):
-        """Retrieve the token, refreshing if necessary."""
-        current_time = time.time()
+    def _update(self):
+        """Log in or refresh, depending on how stale the tokens are."""
         if self.tokens is None:
             self.tokens = self._login()
-        elif current_time > self.refresh_expire_time:
+        elif time.time() > self.refresh_expire_time:
             self.tokens = self._login()
-        elif current_time > self.expire_time:
+        else:
             self.tokens = self._refresh()
-        return self.tokens["access_token"]
 
-    @property
-    def auth_headers(self):
-        return {"Authorization": f"Bearer {self.get()}"}
 
-    
-class BlizzardToken(AccessToken):
+class BlizzardToken(OAuthToken):
+
+    _cached_attributes = ["tokens", "expire_time", "refresh_expire_time"]
 
     def __init__(
         self,
         client_id,
         client_secret,
         leeway=60,
+        cache: TokenCache = None,
     ):
         """Initialize the instance."""
+        super().__init__(leeway=leeway, cache=cache)
         self.client_id = client_id
         self.client_secret = client_secret
-        # Token initialization is lazy: no guarantees you have a valid token
-        # until you try calling `get()`
-        self.tokens = None
-        self.expire_time = None
-        self.leeway = leeway
+        self.refresh_expire_time = None
 
     def _login(self):
         """Get the access token with the login flow."""
@@ -156,15 +293,6 @@ class BlizzardToken(AccessToken):
         )
         return self.tokens
 
-    def get(self):
-        """Retrieve the token, refreshing if necessary."""
-        current_time = time.time()
-        if self.tokens is None:
-            self.tokens = self._login()
-        elif current_time > self.expire_time:
-            self.tokens = self._login()
-        return self.tokens["access_token"]
-
-    @property
-    def auth_headers(self):
-        return {"Authorization": f"Bearer {self.get()}"}
+    def _update(self):
+        """Log in again; client credentials have no refresh flow."""
+        self.tokens = self._login()
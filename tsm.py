@@ -3,14 +3,12 @@ import glob
 import logging
 import os
 import pickle
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from requests import HTTPError
 
-from cytoolz import assoc_in
-
-from hxxp import Requester
+from context import current
 from hxxp import DefaultHandlers
-from tokens import TSMToken
-from _keys import tsm_key
 
 
 logging.basicConfig()
@@ -21,33 +19,132 @@ logger.setLevel(logging.DEBUG)
 _json = DefaultHandlers.raise_or_return_json
 
 
-tok = TSMToken(tsm_key)
-realm_api = Requester("https://realm-api.tradeskillmaster.com", token=tok)
-price_api = Requester("https://pricing-api.tradeskillmaster.com", token=tok)
+# The token and requesters live on the application context so they are only
+# built (and the key only imported) when first used.  These names are still
+# served from the module for existing callers.
+_context_attributes = {
+    "tok": "tsm_token",
+    "realm_api": "realm_api",
+    "price_api": "price_api",
+}
+
+
+def __getattr__(name):
+    if name in _context_attributes:
+        return getattr(current(), _context_attributes[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class TSMRecord(Mapping):
+    """
+    One item of a TSM AH snapshot, merged with its region-wide stats.
+
+    Reads like the dict it replaces, but the known fields are slots, so the
+    tens of thousands of records in a snapshot stay small.  Region fields that
+    clash with AH fields get a "region_" prefix; fields TSM adds that we don't
+    know about go in `_extra`.
+    """
+
+    _ah_fields = (
+        "auctionHouseId", "itemId", "petSpeciesId", "minBuyout", "quantity",
+        "marketValue", "historical", "numAuctions",
+    )
+    _region_fields = (
+        "regionId", "region_quantity", "region_marketValue",
+        "region_historical", "avgSalePrice", "salePct", "soldPerDay",
+    )
+    _fields = _ah_fields + _region_fields
+    __slots__ = _fields + ("_extra",)
+
+    def __init__(self, **fields):
+        self._extra = None
+        for (k, v) in fields.items():
+            self[k] = v
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
 
+    def __iter__(self):
+        for k in self._fields:
+            if hasattr(self, k):
+                yield k
+        if self._extra:
+            yield from self._extra
 
-def _adjust(record):
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"TSMRecord({dict(self)!r})"
+
+
+# Region fields that would clash with the AH's own
+_region_overlap = {"quantity", "marketValue", "historical"}
+
+
+def _merge_region(record, region):
+    for (k, v) in region.items():
+        record[f"region_{k}" if k in _region_overlap else k] = v
     # Looks like the percent got a new sigfig, so divide by 10 here
-    return assoc_in(record, ["salePct"], record["salePct"]/10)
+    if "salePct" in region:
+        record["salePct"] = region["salePct"]/10
+
+
+def region_snapshot(region_id):
+    """
+    Region-wide stats of every item, {item_id: row}.
+
+    The same for every AH in the region and slow to change, so it is worth
+    keeping as its own snapshot and joining AH snapshots against it.
+    """
+    reg = _json(current().price_api.request("GET", f"/region/{region_id}"))
+    return {r["itemId"]: r for r in reg}
+
 
+def join_region(ah, region):
+    """Merge raw `/ah` rows with a `region_snapshot` into `TSMRecord`s."""
+    snapshot = {a["itemId"]: TSMRecord(**a) for a in ah}
+    # Only items listed on this AH are kept
+    for (item_id, record) in snapshot.items():
+        r = region.get(item_id)
+        if r is not None:
+            _merge_region(record, r)
+    return snapshot
 
-def auction_house_snapshot(region_id, realm_id, ah_id):
-    ah = _json(ah1_res := price_api.request("GET", f"/ah/{ah_id}"))
-    reg = _json(reg1_res := price_api.request("GET", f"/region/{region_id}"))
 
-    overlap = ["quantity", "marketValue", "historical"]
+def auction_house_snapshot(region_id, realm_id, ah_id, region=None):
+    """
+    The AH's TSM prices joined with its region's stats.
 
-    reg_formatted = [
-        {
-            (f"region_{k}" if k in overlap else k): r[k]
-            for k in r
-        }
-        for r in reg
-    ]
+    Pass `region` (a `region_snapshot` of `region_id`) to reuse region data
+    already at hand; otherwise it is fetched along with the AH data.
+    """
+    price_api = current().price_api
+    if region is not None:
+        ah = _json(price_api.request("GET", f"/ah/{ah_id}"))
+        return join_region(ah, region)
 
-    ah_index = {a["itemId"]: a for a in ah}
-    reg_index = {a["itemId"]: a for a in reg_formatted}
-    return {
-        x["itemId"]: _adjust({**x, **reg_index[x["itemId"]]})
-        for x in ah_index.values()
-    }
+    # The two downloads don't depend on each other
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        ah_future = pool.submit(price_api.request, "GET", f"/ah/{ah_id}")
+        reg_future = pool.submit(
+            price_api.request, "GET", f"/region/{region_id}",
+        )
+        ah = _json(ah_future.result())
+        reg = _json(reg_future.result())
+    return join_region(ah, {r["itemId"]: r for r in reg})
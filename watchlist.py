@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Watch the items in `notable_items.txt` and alert when rules trip.
+
+The watchlist is read and its item IDs resolved once.  A `Watcher` subscribed
+to the Blizzard and TSM snapshot streams then keeps a small summary per
+watched item (cheapest listing, quantity listed, TSM market value) and checks
+every rule against it on each new snapshot, so the work per snapshot is a
+few lookups per watched item.
+
+Each line of a watchlist is an item name, optionally followed by rules for
+that item:
+
+    titanium bar
+    eternal shadow | min < 12g50s; supply > 2x
+
+Items without rules of their own get the default ones.  The rules are:
+
+    min < PRICE               cheapest listing below PRICE (e.g. 50g, 1g20s)
+    min < market - N%         cheapest listing N% or more below market value
+    supply > Nx               N times as many listed as the last snapshot
+
+An alert is raised when a rule starts to hold, not on every snapshot while it
+keeps holding.
+"""
+import datetime
+import re
+
+from orderbook import OrderBookIndex
+from procure import format_gold
+
+
+default_rules = ["min < market - 30%", "supply > 2x"]
+
+
+def parse_gold(text):
+    """
+    Parse a price like "12g50s", "75s" or "1g 2s 3c" into copper.
+
+    A bare number is taken to be copper already.
+    """
+    text = text.replace(" ", "").lower()
+    if re.fullmatch(r"\d+(\.\d+)?", text):
+        return float(text)
+    match = re.fullmatch(
+        r"(?:(\d+(?:\.\d+)?)g)?(?:(\d+)s)?(?:(\d+)c)?",
+        text,
+    )
+    if not match or not text:
+        raise ValueError(f"Not a price: '{text}'")
+    (g, s, c) = (float(x) if x else 0 for x in match.groups())
+    return g * 10000 + s * 100 + c
+
+
+class MinBelow:
+    """Cheapest listing is below a fixed price."""
+
+    def __init__(self, price):
+        self.price = price
+
+    def check(self, now, before):
+        if now.get("min") is not None and now["min"] < self.price:
+            return (
+                f"min {format_gold(now['min'])} below "
+                f"{format_gold(self.price)}"
+            )
+
+    def __repr__(self):
+        return f"min < {format_gold(self.price)}"
+
+
+class BelowMarket:
+    """Cheapest listing is some percent below TSM's market value."""
+
+    def __init__(self, percent):
+        self.percent = percent
+
+    def check(self, now, before):
+        (low, market) = (now.get("min"), now.get("marketValue"))
+        if low is None or not market:
+            return None
+        discount = 100 * (1 - low / market)
+        if discount >= self.percent:
+            return (
+                f"min {format_gold(low)} is {discount:.0f}% below market "
+                f"{format_gold(market)}"
+            )
+
+    def __repr__(self):
+        return f"min < market - {self.percent:g}%"
+
+
+class SupplySpike:
+    """Quantity listed grew by some factor since the previous snapshot."""
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def check(self, now, before):
+        (q, q_before) = (now.get("quantity"), (before or {}).get("quantity"))
+        if q is None or not q_before:
+            return None
+        if q >= self.factor * q_before:
+            return f"supply up from {q_before} to {q}"
+
+    def __repr__(self):
+        return f"supply > {self.factor:g}x"
+
+
+_rule_patterns = [
+    (
+        r"min\s*<\s*market\s*-\s*(\d+(?:\.\d+)?)\s*%",
+        lambda x: BelowMarket(float(x)),
+    ),
+    (r"min\s*<\s*(.+)", lambda x: MinBelow(parse_gold(x))),
+    (r"supply\s*>\s*(\d+(?:\.\d+)?)\s*x", lambda x: SupplySpike(float(x))),
+]
+
+
+def parse_rule(text):
+    text = text.strip().lower()
+    for (pattern, make) in _rule_patterns:
+        match = re.fullmatch(pattern, text)
+        if match:
+            return make(match.group(1))
+    raise ValueError(f"Unknown rule: '{text}'")
+
+
+def read_watchlist(f, rules=None):
+    """
+    Return [(item name, [rule])] from a watchlist file.
+
+    Items without rules of their own get `rules` (`default_rules` if None).
+    Blank lines and lines starting with "#" are skipped.
+    """
+    defaults = [parse_rule(r) for r in (rules or default_rules)]
+    watchlist = []
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        (name, _, rule_text) = line.partition("|")
+        item_rules = [
+            parse_rule(r) for r in rule_text.split(";") if r.strip()
+        ]
+        watchlist.append((name.strip(), item_rules or defaults))
+    return watchlist
+
+
+class Watcher:
+    """
+    Check a watchlist against every new snapshot.
+
+    `attach` subscribes to a Blizzard and a TSM `SnapshotProcessor`.  New
+    Blizzard snapshots update the listing summaries and trigger the checks;
+    new TSM snapshots only update market values.  Alerts go to `alert` as
+    single lines.
+    """
+
+    def __init__(self, items, watchlist, alert=print):
+        self.alert = alert
+        names = [name for (name, _) in watchlist]
+        # One lookup (and cache commit) for the whole list
+        ids = items.get_multiple_ids(names)
+        self.watched = [
+            (name, item_id, rules)
+            for ((name, rules), item_id) in zip(watchlist, ids)
+        ]
+        # item_id -> {"min", "quantity", "marketValue"}
+        self.summaries = {item_id: {} for (_, item_id, _) in self.watched}
+        self._previous = {}
+        # (item_id, rule index) pairs whose rule held at the last check
+        self._firing = set()
+        # `OrderBookIndex` of the last Blizzard snapshot
+        self._books = None
+
+    def update_auctions(self, bliz_ah, books=None):
+        """
+        Take a new Blizzard snapshot and check the rules.
+
+        `books` is the snapshot's `OrderBookIndex`, if one was built
+        already.
+        """
+        if books is not None:
+            self._books = books
+        self._previous = {
+            item_id: dict(summary)
+            for (item_id, summary) in self.summaries.items()
+        }
+        if self._books is None or self._books.snapshot is not bliz_ah:
+            self._books = OrderBookIndex(bliz_ah)
+        for (item_id, summary) in self.summaries.items():
+            # Listings are sorted once per snapshot by the index
+            book = self._books.book(item_id)
+            if book is None or not book.depth:
+                (summary["min"], summary["quantity"]) = (None, 0)
+            else:
+                summary["min"] = float(book.prices[0])
+                summary["quantity"] = int(book.depth)
+        self.check()
+
+    def update_tsm(self, tsm_ah):
+        for (item_id, summary) in self.summaries.items():
+            record = tsm_ah.get(item_id)
+            summary["marketValue"] = record and record.get("marketValue")
+
+    def check(self):
+        """Run every rule; alert on the ones that just started holding."""
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        for (name, item_id, rules) in self.watched:
+            summary = self.summaries[item_id]
+            before = self._previous.get(item_id)
+            for (j, rule) in enumerate(rules):
+                message = rule.check(summary, before)
+                key = (item_id, j)
+                if message and key not in self._firing:
+                    self._firing.add(key)
+                    self.alert(f"{now}  {name}: {message}  [{rule!r}]")
+                elif not message:
+                    self._firing.discard(key)
+
+    def attach(self, bliz_snap, tsm_snap):
+        # TSM first, so the first check already has market values
+        tsm_snap.subscribe(self.update_tsm)
+        bliz_snap.subscribe(self.update_auctions)
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Alert when watched items cross price or supply rules",
+    )
+    parser.add_argument("-w", "--watchlist", default="notable_items.txt")
+    parser.add_argument(
+        "--rule",
+        action="append",
+        help=(
+            "Rule for items without their own, e.g. 'min < 50g' (repeatable; "
+            f"default: {'; '.join(default_rules)})"
+        ),
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="Append alerts to this file instead of printing them",
+    )
+    parser.add_argument(
+        "-i", "--interval",
+        type=int,
+        default=300,
+        help="Seconds between snapshot checks",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Check the current snapshots and exit",
+    )
+    parsed = parser.parse_args()
+
+    from context import current
+
+    with open(parsed.watchlist) as f:
+        watchlist = read_watchlist(f, rules=parsed.rule)
+
+    if parsed.output:
+        def alert(line):
+            with open(parsed.output, "a") as f:
+                print(line, file=f)
+    else:
+        alert = print
+
+    ctx = current()
+    watcher = Watcher(ctx.items, watchlist, alert=alert)
+    watcher.attach(ctx.bliz_ah_snap, ctx.tsm_ah_snap)
+    while True:
+        # Subscribers run whenever these load a new snapshot
+        ctx.tsm_ah_snap.get(max_age_seconds=3000)
+        ctx.bliz_ah_snap.get(max_age_seconds=3000)
+        if parsed.once:
+            break
+        time.sleep(parsed.interval)
+
+
+if __name__ == "__main__":
+    main()